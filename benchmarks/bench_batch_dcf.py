@@ -0,0 +1,75 @@
+"""
+Throughput of the batch DCF engine (valuation.dcf) against the per-object Stock.compute_valuation loop.
+
+Usage: python benchmarks/bench_batch_dcf.py [N ...]
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+from stock import Stock
+from valuation import dcf
+
+SIZES = (10_000, 100_000)
+SCALAR_SAMPLE = 2_000  # the scalar loop is timed on a sample and extrapolated
+REPEATS = 5
+
+
+def random_inputs(n, seed=42):
+    rng = np.random.default_rng(seed)
+    return {
+        'free_cash_flow': rng.lognormal(20, 2, n) * rng.choice([1, -1], n, p=[0.9, 0.1]),
+        'cash': rng.lognormal(20, 2, n),
+        'total_debt': rng.lognormal(20, 2, n),
+        'outstanding_shares': rng.lognormal(19, 1, n),
+        'beta': rng.uniform(0, 2.5, n),
+        'eps_next_5y': rng.normal(0.05, 0.08, n),
+    }
+
+
+def scalar_fair_prices(inputs, n):
+    fair_prices = np.empty(n)
+    for i in range(n):
+        stock = Stock(f'S{i}')
+        stock.free_cash_flow = inputs['free_cash_flow'][i]
+        stock.cash = inputs['cash'][i]
+        stock.total_debt = inputs['total_debt'][i]
+        stock.outstanding_shares = inputs['outstanding_shares'][i]
+        stock.beta = inputs['beta'][i]
+        stock.eps_next_5y = inputs['eps_next_5y'][i]
+        stock.compute_valuation()
+        fair_prices[i] = stock.fair_price
+    return fair_prices
+
+
+def best_time(func, repeats=REPEATS):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(sizes):
+    print(f"{'symbols':>10} {'batch (s)':>10} {'batch sym/s':>14} {'scalar sym/s':>14} {'speedup':>9} {'max rel err':>12}")
+    for n in sizes:
+        inputs = random_inputs(n)
+        batch_seconds = best_time(lambda: dcf.compute_fair_prices(**inputs))
+        _, fair_prices = dcf.compute_fair_prices(**inputs)
+
+        sample = min(n, SCALAR_SAMPLE)
+        scalar_seconds = best_time(lambda: scalar_fair_prices(inputs, sample), repeats=1) * n / sample
+        expected = scalar_fair_prices(inputs, sample)
+        max_rel_err = np.max(np.abs(fair_prices[:sample] - expected) / np.maximum(np.abs(expected), 1e-12))
+
+        print(f'{n:>10,} {batch_seconds:>10.4f} {n / batch_seconds:>14,.0f} {n / scalar_seconds:>14,.0f} '
+              f'{scalar_seconds / batch_seconds:>8.0f}x {max_rel_err:>12.2e}')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,306 @@
+"""
+Offline benchmark suite: per-stage costs and end-to-end throughput against the local stub server,
+without any request to the real API. Results are written as JSON so runs of different versions can be compared.
+
+Usage: python benchmarks/run_benchmarks.py [--symbols 500] [--latency-ms 0] [--output FILE] [--compare BASELINE]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+RESULTS_DIR = BENCHMARKS_DIR / 'results'
+sys.path.insert(0, str(BENCHMARKS_DIR.parent / 'src'))
+os.environ.setdefault('ALPHA_VANTAGE_PREM_API_KEY', 'benchmark')  # only ever sent to the stub server
+
+from stub_server import start_stub_server, load_fixtures  # noqa: E402
+import pipeline  # noqa: E402
+import rendering  # noqa: E402
+from service.cache_store import CacheStore  # noqa: E402
+from service.data_service import DataService  # noqa: E402
+from service.fundamentals_store import ENDPOINTS, FundamentalsStore  # noqa: E402
+from service.http_client import HttpClient  # noqa: E402
+from service.rate_limiter import TokenBucket  # noqa: E402
+from service.response_cache import ResponseCache  # noqa: E402
+from stock import Stock  # noqa: E402
+from stock_repository import StockRepository  # noqa: E402
+from utils import utils  # noqa: E402
+from valuation import growth  # noqa: E402
+
+UNLIMITED_RATE = 1e9  # requests per minute, the benchmarks measure this tool, not the quota
+REGRESSION_TOLERANCE = 0.2  # fraction by which a stage may get slower before it is reported
+
+
+def measure(func, operations, repeats=3):
+    """
+    Runs `func` `repeats` times and keeps the fastest run.
+    :param func: callable doing `operations` operations per call.
+    :param operations: number of operations per call, to report per-operation costs.
+    :return: dictionary with the total seconds, microseconds per operation and operations per second.
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return {'operations': operations, 'seconds': best, 'us_per_op': best / operations * 1e6,
+            'ops_per_s': operations / best}
+
+
+def new_data_service(work_dir, name):
+    rate_limiter = TokenBucket(UNLIMITED_RATE, 1000)
+    return DataService(rate_limiter, ResponseCache(os.path.join(work_dir, name)),
+                       HttpClient(max_retries=0, rate_limiter=rate_limiter))
+
+
+def symbol_names(count, prefix='S'):
+    return [f'{prefix}{i:06d}' for i in range(count)]
+
+
+def bench_fetch(work_dir, symbols):
+    counter = iter(range(1_000_000))
+
+    def run():
+        data_service = new_data_service(work_dir, f'fetch-{next(counter)}')
+        for symbol in symbols:
+            data_service.fetch_all_data(symbol)
+
+    return measure(run, len(symbols), repeats=1)
+
+
+def bench_fetch_async(work_dir, symbols):
+    counter = iter(range(1_000_000))
+
+    def run():
+        data_service = new_data_service(work_dir, f'fetch-async-{next(counter)}')
+        data_service.prefetch(symbols)
+
+    return measure(run, len(symbols), repeats=1)
+
+
+def bench_json_parse(fixtures):
+    texts = list(fixtures.values()) * 200
+    return measure(lambda: [json.loads(text) for text in texts], len(texts))
+
+
+def parsed_response(fixtures):
+    responses = {func: json.loads(fixtures[func.get_url_name()]) for func in pipeline_functions()}
+    return DataService.parse_all_data('BENCH', responses)
+
+
+def pipeline_functions():
+    from utils.api_function_enum import ApiFunction
+    return list(ApiFunction)
+
+
+def bench_stock_get_data(work_dir, fixtures, symbols):
+    response = parsed_response(fixtures)
+    counter = iter(range(1_000_000))
+
+    def run():
+        cache_store = CacheStore(os.path.join(work_dir, f'get-data-{next(counter)}.csv'))
+        data_service = new_data_service(work_dir, 'get-data-responses')
+        data_service.prefetched = {symbol: response for symbol in symbols}
+        for symbol in symbols:
+            Stock(symbol, cache_store=cache_store, data_service=data_service)
+        cache_store.flush()
+
+    return measure(run, len(symbols))
+
+
+def valued_stocks(work_dir, fixtures, symbols):
+    cache_store = CacheStore(os.path.join(work_dir, 'valued.csv'))
+    data_service = new_data_service(work_dir, 'valued-responses')
+    data_service.prefetched = {symbol: parsed_response(fixtures) for symbol in symbols}
+    stocks = [Stock(symbol, cache_store=cache_store, data_service=data_service) for symbol in symbols]
+    cache_store.flush()
+    return cache_store, stocks
+
+
+def bench_cache_load(cache_store):
+    return measure(lambda: CacheStore(cache_store.cache_file), len(cache_store))
+
+
+def bench_cache_lookup(cache_store, symbols):
+    return measure(lambda: [cache_store.get(symbol) for symbol in symbols], len(symbols))
+
+
+def bench_repository(cache_store):
+    return measure(lambda: StockRepository.from_cache_store(cache_store), len(cache_store))
+
+
+def bench_compute_valuation(stocks):
+    return measure(lambda: [stock.compute_valuation() for stock in stocks], len(stocks))
+
+
+def bench_format_currency(stocks):
+    amounts = [stock.present_value for stock in stocks]
+    return measure(lambda: [utils.format_currency(amount) for amount in amounts], len(amounts))
+
+
+def bench_get_as_row(stocks):
+    return measure(lambda: [stock.get_as_row() for stock in stocks], len(stocks))
+
+
+def stock_result_columns(stocks):
+    repository = StockRepository.from_stocks(stocks)
+    columns = dict(repository.columns, symbol=np.array(repository.symbols),
+                   name=np.array([name or '' for name in repository.names]))
+    return rendering.result_columns(columns)
+
+
+def bench_render_table(stocks):
+    columns = stock_result_columns(stocks)
+    return measure(lambda: rendering.format_table(columns), len(stocks))
+
+
+def bench_export(work_dir, stocks, export_format):
+    columns = stock_result_columns(stocks)
+    path = os.path.join(work_dir, f'values.{export_format}')
+    return measure(lambda: rendering.export(columns, path, export_format), len(stocks))
+
+
+def bench_csv_write(work_dir, stocks):
+    rows = [stock.get_as_row() for stock in stocks]
+    batches = [rows[i:i + pipeline.FETCH_BATCH_SIZE] for i in range(0, len(rows), pipeline.FETCH_BATCH_SIZE)]
+
+    def run():
+        with pipeline.ResultsSink(os.path.join(work_dir, 'results.csv')) as sink:
+            for batch in batches:
+                sink.write([row[0] for row in batch], batch)
+
+    return measure(run, len(rows))
+
+
+def bench_fundamentals_ingest(work_dir, fixtures, symbols):
+    response_cache = ResponseCache(os.path.join(work_dir, 'fundamentals-responses'))
+    for symbol in symbols:
+        for func in ENDPOINTS:
+            response_cache.put(func, symbol, json.loads(fixtures[func.get_url_name()]))
+    counter = iter(range(1_000_000))
+
+    def run():
+        FundamentalsStore(os.path.join(work_dir, f'fundamentals-{next(counter)}.npz')).ingest(response_cache, symbols)
+
+    store = FundamentalsStore(os.path.join(work_dir, 'fundamentals.npz'))
+    store.ingest(response_cache, symbols)
+    return measure(run, len(symbols)), store
+
+
+def bench_growth_estimate(store, symbols):
+    return measure(lambda: growth.estimate(store, symbols), len(symbols))
+
+
+def bench_end_to_end(work_dir, symbols, use_async):
+    counter = iter(range(1_000_000))
+
+    def run():
+        run_id = next(counter)
+        cache_store = CacheStore(os.path.join(work_dir, f'e2e-{use_async}-{run_id}.csv'))
+        data_service = new_data_service(work_dir, f'e2e-{use_async}-{run_id}')
+        with pipeline.ResultsSink(os.path.join(work_dir, f'e2e-{use_async}-{run_id}-results.csv')) as sink:
+            batches = pipeline.fetch_stage(pipeline.symbols_stage(symbols), cache_store, data_service, use_async)
+            for batch, stocks in pipeline.value_stage(batches, cache_store, data_service):
+                sink.write(batch, [stock.get_as_row() for stock in stocks])
+        cache_store.flush()
+
+    return measure(run, len(symbols), repeats=1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, tolerance=REGRESSION_TOLERANCE):
+    """
+    Reports the stages that got slower than in the baseline by more than `tolerance`.
+    :return: list of regressed stage names.
+    """
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        change = result['us_per_op'] / baseline[stage]['us_per_op'] - 1
+        flag = 'REGRESSION' if change > tolerance else ''
+        print(f'{stage:>22} {baseline[stage]["us_per_op"]:>14,.1f} {result["us_per_op"]:>14,.1f} {change:>+8.1%} {flag}')
+        if flag:
+            regressions.append(stage)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--symbols', type=int, default=500, help='symbols per stage (default: %(default)s)')
+    parser.add_argument('--network-symbols', type=int, default=100,
+                        help='symbols fetched from the stub server in the network stages (default: %(default)s)')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='stub server latency (default: %(default)s)')
+    parser.add_argument('--output', help='JSON file to write, defaults to benchmarks/results/<timestamp>.json')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    server, api_url = start_stub_server(latency_ms=args.latency_ms)
+    os.environ['ALPHA_VANTAGE_API_URL'] = api_url
+    fixtures = load_fixtures()
+    symbols = symbol_names(args.symbols)
+    network_symbols = symbol_names(args.network_symbols, prefix='N')
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        results['fetch_sync'] = bench_fetch(work_dir, network_symbols)
+        results['fetch_async'] = bench_fetch_async(work_dir, network_symbols)
+        results['json_parse'] = bench_json_parse(fixtures)
+        results['stock_get_data'] = bench_stock_get_data(work_dir, fixtures, symbols)
+        cache_store, stocks = valued_stocks(work_dir, fixtures, symbols)
+        results['cache_load'] = bench_cache_load(cache_store)
+        results['cache_lookup'] = bench_cache_lookup(cache_store, symbols)
+        results['repository_build'] = bench_repository(cache_store)
+        results['compute_valuation'] = bench_compute_valuation(stocks)
+        results['format_currency'] = bench_format_currency(stocks)
+        results['get_as_row'] = bench_get_as_row(stocks)
+        results['csv_write'] = bench_csv_write(work_dir, stocks)
+        results['render_table'] = bench_render_table(stocks)
+        results['export_csv'] = bench_export(work_dir, stocks, 'csv')
+        results['export_jsonl'] = bench_export(work_dir, stocks, 'jsonl')
+        results['fundamentals_ingest'], fundamentals = bench_fundamentals_ingest(work_dir, fixtures, symbols)
+        results['growth_estimate'] = bench_growth_estimate(fundamentals, symbols)
+        results['end_to_end_sync'] = bench_end_to_end(work_dir, network_symbols, use_async=False)
+        results['end_to_end_async'] = bench_end_to_end(work_dir, network_symbols, use_async=True)
+    server.shutdown()
+
+    print(f"{'stage':>22} {'operations':>11} {'us/op':>14} {'ops/s':>14}")
+    for stage, result in results.items():
+        print(f"{stage:>22} {result['operations']:>11,} {result['us_per_op']:>14,.1f} {result['ops_per_s']:>14,.0f}")
+
+    report = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'git_commit': git_commit(),
+              'python': platform.python_version(), 'platform': platform.platform(), 'config': vars(args),
+              'results': results}
+    output = args.output or RESULTS_DIR / f"{datetime.now():%Y-%m-%dT%H-%M-%S}.json"
+    with open(output, mode='w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}')
+
+    if args.compare:
+        print(f"\n{'stage':>22} {'baseline us/op':>14} {'us/op':>14} {'change':>8}")
+        if compare(results, args.compare):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Local stub of the Alpha Vantage API that replays the responses in benchmarks/fixtures for any symbol,
+with configurable latency, throttling and failures.
+
+Usage: python benchmarks/stub_server.py [--port 8765] [--latency-ms 150] [--throttle-every 0] [--error-rate 0]
+Then point the calculator at it: ALPHA_VANTAGE_API_URL=http://127.0.0.1:8765/query
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures'
+THROTTLE_BODY = {'Note': 'Thank you for using Alpha Vantage! Our standard API call frequency is 75 requests per '
+                         'minute. Please subscribe to any of the premium plans to instantly remove all daily rate limits.'}
+
+
+def load_fixtures(fixtures_dir=FIXTURES_DIR):
+    """
+    :return: dictionary of function name (e.g. 'CASH_FLOW') to the raw text of its fixture.
+    """
+    return {path.stem: path.read_text(encoding='utf-8') for path in Path(fixtures_dir).glob('*.json')}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    disable_nagle_algorithm = True  # headers and body go out in separate writes, don't wait for delayed ACKs
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            request_number = server.request_count
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if server.error_rate and random.random() < server.error_rate:
+            return self.reply(503, {'Error': 'Service unavailable'})
+        if server.throttle_every and request_number % server.throttle_every == 0:
+            return self.reply(200, THROTTLE_BODY)
+
+        query = parse_qs(urlparse(self.path).query)
+        function = query.get('function', [''])[0]
+        symbol = query.get('symbol', [''])[0]
+        if function == 'REALTIME_BULK_QUOTES':
+            quote = json.loads(server.fixtures['GLOBAL_QUOTE'])['Global Quote']
+            return self.reply(200, {'endpoint': 'Realtime Bulk Quotes', 'data': [
+                {'symbol': s, 'close': quote['05. price'], 'previous_close': quote['08. previous close']}
+                for s in symbol.split(',')]})
+        if function not in server.fixtures:
+            return self.reply(200, {'Error Message': f'Invalid API call: unknown function {function}'})
+
+        self.reply_text(200, server.fixtures[function].replace('{symbol}', symbol))
+
+    def reply(self, status, body):
+        self.reply_text(status, json.dumps(body))
+
+    def reply_text(self, status, text):
+        payload = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # keep benchmark output clean
+
+
+def start_stub_server(port=0, latency_ms=0.0, jitter_ms=0.0, throttle_every=0, error_rate=0.0,
+                      fixtures_dir=FIXTURES_DIR):
+    """
+    Starts the stub server in a daemon thread.
+    :param port: port to listen on, 0 for any free port.
+    :param latency_ms: delay added to every response.
+    :param jitter_ms: maximum random delay added on top of `latency_ms`.
+    :param throttle_every: answer every N-th request with a throttle message, 0 to never throttle.
+    :param error_rate: fraction of requests answered with status 503.
+    :return: tuple (server, API URL to set in ALPHA_VANTAGE_API_URL). Call server.shutdown() when done.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.fixtures = load_fixtures(fixtures_dir)
+    server.latency = latency_ms / 1000
+    server.jitter = jitter_ms / 1000
+    server.throttle_every = throttle_every
+    server.error_rate = error_rate
+    server.request_count = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/query'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=150.0)
+    parser.add_argument('--jitter-ms', type=float, default=50.0)
+    parser.add_argument('--throttle-every', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub, url = start_stub_server(args.port, args.latency_ms, args.jitter_ms, args.throttle_every, args.error_rate)
+    print(f'Serving fixtures at {url}. Press Ctrl+C to stop.')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub.shutdown()
@@ -1,29 +1,457 @@
+import argparse
+import os
+import sys
 from datetime import date
 
-from tabulate import tabulate
-from utils import utils
-from stock import Stock
+from utils import paths, utils
+from utils.metrics import METRICS
 
-SYMBOLS_PATH = 'C:\\projects\\intrinsic-value-calc\\data\\symbols\\symbols.txt'
-RESULTS_PATH = 'C:\\projects\\intrinsic-value-calc\\data\\results\\{}-results.csv'
+# files in the data directory, see utils.paths
+RESULTS_FILE = os.path.join('results', '{}-results.csv')
+SHARD_RESULTS_FILE = os.path.join('results', '{}-results.shard-{}-of-{}.csv')
+EXPORT_FILE = os.path.join('results', '{}-values.{}')  # raw numbers, one file per format
 LOGGER = utils.set_up_logger()
 
+# Every command imports what it needs when it runs, and only the arguments of the command being run are declared,
+# so that cheap commands like `cache` don't pay for requests, numpy or tabulate.
+COMMANDS = {
+    'value': 'value every symbol of the symbols file (the default command)',
+    'reprice': 'fetch the latest price of the cached symbols and value every symbol with it',
+    'serve': 'serve valuations on demand over HTTP',
+    'symbols': 'show or update the symbols file',
+    'cache': 'query the cache without any network call',
+}
+DEFAULT_COMMAND = 'value'
 
-if __name__ == '__main__':
-    symbol_list = utils.text_to_list(SYMBOLS_PATH)
 
-    # Add headers to table
-    table = [['symbol', 'name', 'currentPrice', 'fairPrice', 'currentPricePerShare',
-          'fairPricePerShare', 'priceToBookRatio', 'current/fair(%)']]
+def parse_args(argv=None):
+    """
+    :param argv: command line arguments, sys.argv[1:] if None. The command comes first, DEFAULT_COMMAND is run
+    if there is none.
+    :return: the parsed arguments, with the function running the command as `func`.
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    command = argv[0] if argv else None
+    if command not in COMMANDS and command not in ('-h', '--help'):
+        command = DEFAULT_COMMAND  # the command line of earlier versions, which had no commands
+        argv.insert(0, command)
 
-    for symbol in symbol_list:
-        stock = Stock(symbol)
-        if stock.fair_price is None:
-            LOGGER.info("Fair price for [%s] could not be determined. Skipping...", stock.symbol)
-        else:
-            table.append(stock.get_as_row())
+    parser = argparse.ArgumentParser(description='Calculates the fair price of US publicly-traded companies.')
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND', title='commands')
+    for name, help_text in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text, description=help_text)
+        subparser.add_argument('--data-dir',
+                               help=f'data directory, defaults to ${paths.DATA_DIR_ENV} or the data directory '
+                                    f'of the project')
+        if name == command:
+            ADD_ARGUMENTS[name](subparser)
+    return parser.parse_args(argv)
+
+
+def add_connection_arguments(parser):
+    from service.data_service import MAX_IN_FLIGHT
+    from service.http_client import TIMEOUT, MAX_RETRIES
+    from service.rate_limiter import REQUESTS_PER_MINUTE, BURST
+
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help='maximum number of concurrent requests (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=REQUESTS_PER_MINUTE,
+                        help='maximum sustained requests per minute (default: %(default)s)')
+    parser.add_argument('--burst', type=int, default=BURST,
+                        help='maximum number of requests sent at once (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT[1],
+                        help='seconds to wait for a response before retrying (default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES,
+                        help='retries of a failed or throttled request (default: %(default)s)')
+
+
+def add_value_arguments(parser):
+    parser.set_defaults(reprice=False)
+    add_run_arguments(parser)
+    parser.add_argument('--revalue', action='store_true',
+                        help='value the cached symbols again with the current model, without any network call')
+
+
+def add_reprice_arguments(parser):
+    parser.set_defaults(reprice=True, revalue=False)
+    add_run_arguments(parser)
+
+
+def add_run_arguments(parser):
+    import rendering
+    from valuation import scenarios
+
+    parser.set_defaults(func=value_symbols)
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='fetch the symbols missing from the cache concurrently, one batch at a time')
+    parser.add_argument('--resume', action='store_true',
+                        help="continue today's interrupted run, skipping the symbols it already completed")
+    parser.add_argument('--no-table', dest='table', action='store_false',
+                        help="don't print the results table when done")
+    parser.add_argument('--table-format', default='fancy_grid',
+                        help="tabulate format of the printed table, e.g. 'simple' is faster for large tables "
+                             "(default: %(default)s)")
+    parser.add_argument('--export', nargs='+', choices=rendering.EXPORT_FORMATS, default=[], metavar='FORMAT',
+                        help='also write the results as raw numbers, in any of: %(choices)s')
+    add_connection_arguments(parser)
+    parser.add_argument('--budget', type=int, metavar='REQUESTS',
+                        help='only refresh the most relevant stale symbols within this many requests a day, '
+                             'spreading refreshes over the days, and value the rest from the cache')
+    parser.add_argument('--scenarios', choices=['grid', 'mc'],
+                        help='add fair price percentiles and the probability of being undervalued across a grid '
+                             'of scenarios or Monte Carlo draws')
+    parser.add_argument('--wacc-shifts', type=float_list, default=scenarios.WACC_SHIFTS,
+                        help='comma-separated WACC shifts of the scenario grid')
+    parser.add_argument('--growth-shifts', type=float_list, default=scenarios.GROWTH_SHIFTS,
+                        help='comma-separated stage 1 growth shifts of the scenario grid')
+    parser.add_argument('--fades', type=float_list, default=scenarios.FADES,
+                        help='comma-separated growth fades of the scenario grid')
+    parser.add_argument('--draws', type=int, default=scenarios.DRAWS,
+                        help='number of Monte Carlo draws (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='processes used to value the scenarios, 0 for every core, split between the --processes '
+                             'workers (default: %(default)s)')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='record timings and counters per endpoint and stage, print a summary when done and write '
+                             'them to FILE, in the Prometheus text format if it ends with .prom, as JSON otherwise')
+    sharding = parser.add_mutually_exclusive_group()
+    sharding.add_argument('--processes', type=int, default=1,
+                          help='split the symbols across this many worker processes sharing one rate budget '
+                               '(default: %(default)s)')
+    sharding.add_argument('--shard', type=shard_spec, metavar='INDEX/COUNT',
+                          help='only value shard INDEX of COUNT, e.g. to split the symbols across machines')
+    sharding.add_argument('--merge', action='store_true',
+                          help="render today's results file from the history store, once every shard is done")
+
+
+def add_serve_arguments(parser):
+    from service.valuation_service import VALUATION_TTL, MAX_ENTRIES
+
+    parser.set_defaults(func=run_service)
+    parser.add_argument('port', type=int, help='port to serve on. The API is GET /value/<symbol>, '
+                                               'GET /values?symbols=A,B or POST /values, GET /health and GET /metrics')
+    parser.add_argument('--host', default='127.0.0.1', help='address to serve on (default: %(default)s)')
+    parser.add_argument('--ttl', type=float, default=VALUATION_TTL,
+                        help='seconds a valuation is served from memory before it is refreshed (default: %(default)s)')
+    parser.add_argument('--max-entries', type=int, default=MAX_ENTRIES,
+                        help='valuations kept in memory (default: %(default)s)')
+    add_connection_arguments(parser)
+
+
+def add_symbols_arguments(parser):
+    parser.set_defaults(func=show_symbols)
+    parser.add_argument('--update', action='store_true',
+                        help='update the universe with the symbols of the S&P 500 and the Nasdaq 100 and print '
+                             'the symbols added and removed')
+    parser.add_argument('--refresh-index', action='store_true',
+                        help='with --update, parse the index data again instead of using the cached tickers')
+    parser.add_argument('--changes', nargs='?', const='', metavar='SINCE',
+                        help='print the changes of the universe, since the date SINCE (YYYY-MM-DD) if given')
 
-    utils.write_to_csv(table, RESULTS_PATH.format(date.today()))
-    print(tabulate(table, tablefmt='fancy_grid', showindex=True))
+
+def add_cache_arguments(parser):
+    parser.set_defaults(func=query_cache)
+    parser.add_argument('symbols', nargs='*', metavar='SYMBOL',
+                        help='symbols to show the cached valuation of. Without symbols, only counts the cached rows')
+    parser.add_argument('--json', action='store_true', help='print one JSON record per symbol, as raw numbers')
+
+
+ADD_ARGUMENTS = {'value': add_value_arguments, 'reprice': add_reprice_arguments, 'serve': add_serve_arguments,
+                 'symbols': add_symbols_arguments, 'cache': add_cache_arguments}
+
+
+def float_list(value):
+    return [float(item) for item in value.split(',')]
+
+
+def shard_spec(value):
+    index, count = (int(part) for part in value.split('/'))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard must be INDEX/COUNT with 0 <= INDEX < COUNT, got '{value}'")
+    return index, count
+
+
+def value_symbols(args):
+    """
+    Runs the `value` and `reprice` commands: values every symbol of the symbols file, in this process, in worker
+    processes or in one shard, and prints the results table.
+    :param args: parsed command line arguments.
+    :return: void
+    """
+    from service.cache_store import CacheStore
+    from service.history_store import HistoryStore
+    from service.rate_limiter import TokenBucket, SharedTokenBucket
+    from service.symbol_getter import Universe
+    from valuation.revalue import revalue_cache
+
+    symbol_list = Universe().load()
+    if args.metrics:
+        METRICS.enable()
+
+    if args.revalue:
+        cache_store = CacheStore()
+        with METRICS.timer('stage_seconds', stage='revalue'):
+            revalue_cache(cache_store)
+        symbol_list = [symbol for symbol in symbol_list if symbol in cache_store]
+
+    if args.merge:
+        table = merge_shards(args.export)
+        if args.metrics:
+            report_metrics(args.metrics)
+    elif args.processes > 1:
+        import multiprocessing
+
+        # the workers share one rate budget and the cores, and merge their results when they are all done
+        rate_limiter = SharedTokenBucket(args.rate, args.burst)
+        if not args.workers:
+            args = argparse.Namespace(**dict(vars(args), workers=max(1, (os.cpu_count() or 1) // args.processes)))
+        workers = [multiprocessing.Process(target=run_shard, name=f'shard-{i}',
+                                           args=(args, symbol_list, rate_limiter, i, args.processes))
+                   for i in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = [worker.name for worker in workers if worker.exitcode != 0]
+        if failed:
+            LOGGER.error("Workers %s failed. Run again with --resume to complete their shards.", failed)
+        table = merge_shards(args.export)
+        if args.metrics:  # the timings of the parent, every shard reported its own
+            report_metrics(args.metrics)
+    elif args.shard is not None:
+        table = run_shard(args, symbol_list, TokenBucket(args.rate, args.burst), *args.shard)
+    else:
+        results_path = paths.data_path(RESULTS_FILE.format(date.today()), create_dir=True)
+        table = run(args, symbol_list, TokenBucket(args.rate, args.burst), results_path)
+        HistoryStore().compact(date.today())
+        if args.metrics:
+            report_metrics(args.metrics)
+
+    if args.table:
+        from tabulate import tabulate
+
+        print(tabulate(table, tablefmt=args.table_format, showindex=True))
 
     utils.beep()  # beep when done
+
+
+def run(args, symbol_list, rate_limiter, results_path):
+    """
+    Values every symbol, appends the valuations to the history store and streams the result rows to
+    `results_path`, which is rendered again from the history store when the run is done.
+    :param args: parsed command line arguments.
+    :param symbol_list: symbols to value.
+    :param rate_limiter: rate limiter shared by every request of the run.
+    :param results_path: results file to write.
+    :return: the results table of the symbols of the run, headers included.
+    """
+    import contextlib
+    from concurrent.futures import ProcessPoolExecutor
+
+    import pipeline
+    import rendering
+    from service.cache_store import CacheStore
+    from service.data_service import DataService
+    from service.fundamentals_store import FundamentalsStore
+    from service.history_store import HistoryStore
+    from service.http_client import HttpClient, TIMEOUT
+    from service.refresh_scheduler import RefreshScheduler
+    from valuation import growth, scenarios
+
+    if args.metrics:
+        METRICS.enable()  # again, for worker processes that don't inherit the parent's memory
+    cache_store = CacheStore()  # loaded once and shared by every stock in the run
+    http_client = HttpClient(timeout=(TIMEOUT[0], args.timeout), max_retries=args.retries,
+                             pool_size=args.max_in_flight, rate_limiter=rate_limiter)
+    data_service = DataService(rate_limiter, http_client=http_client)
+    history = HistoryStore()
+    fundamentals = FundamentalsStore()
+
+    if args.budget is not None:
+        scheduler = RefreshScheduler(cache_store, data_service.response_cache, args.budget)
+        symbol_list = list(pipeline.symbols_stage(symbol_list))
+        plan = scheduler.plan(symbol_list)
+        scheduler.prepare(plan)
+        symbol_list = [symbol for symbol in symbol_list if symbol in plan or symbol in cache_store]
+
+    quotes = {}
+    if args.reprice:
+        quotes = data_service.fetch_quotes([symbol for symbol in pipeline.symbols_stage(symbol_list)
+                                            if symbol in cache_store])
+
+    scenario_set = None
+    headers = list(rendering.RESULT_HEADERS)
+    if args.scenarios == 'grid':
+        scenario_set = scenarios.Scenarios.grid(args.wacc_shifts, args.growth_shifts, args.fades)
+    elif args.scenarios == 'mc':
+        scenario_set = scenarios.Scenarios.monte_carlo(args.draws)
+    pool = contextlib.nullcontext()  # no executor
+    if scenario_set is not None:
+        headers.extend(scenarios.SCENARIO_HEADERS)
+        workers = scenarios.get_workers(args.workers)
+        if workers > 1:
+            pool = ProcessPoolExecutor(max_workers=workers)  # started once and reused by every group of the run
+    headers.extend(growth.GROWTH_HEADERS)
+
+    with pool as executor, pipeline.ResultsSink(results_path, headers, args.resume) as sink:
+        symbols = pipeline.symbols_stage(symbol_list, sink.completed)
+        batches = pipeline.fetch_stage(symbols, cache_store, data_service, args.use_async, args.max_in_flight)
+        valued = pipeline.value_stage(batches, cache_store, data_service, quotes, fundamentals)
+        if scenario_set is not None:  # fetch batches are too small to give every worker a chunk
+            valued = pipeline.group_stage(valued, scenarios.group_size(scenario_set, args.workers))
+        for batch, stocks in valued:
+            records = [stock.get_as_record() for stock in stocks]
+            extra_columns = {}
+            if scenario_set is not None and stocks:
+                percentiles, undervalued = scenarios.evaluate_stocks(scenario_set, stocks, args.workers, executor)
+                extra_columns = dict(zip(scenarios.SCENARIO_COLUMNS, [*percentiles.T, undervalued]))
+            if stocks:  # growth estimates from the fundamentals ingested by the value stage
+                extra_columns.update(growth.estimate(fundamentals, [stock.symbol for stock in stocks]))
+            for i, record in enumerate(records):
+                record.update((column, float(values[i])) for column, values in extra_columns.items())
+            history.append_stocks(date.today(), stocks, extra_columns)
+            sink.write(batch, [rendering.format_record(record) for record in records])
+
+    cache_store.close()  # worker processes exit without running atexit handlers
+    fundamentals.save()
+    data_service.response_cache.log_stats()
+    return render_results(history, results_path, set(pipeline.symbols_stage(symbol_list)), args.export)
+
+
+def run_shard(args, symbol_list, rate_limiter, shard_index, shard_count):
+    """
+    Values the symbols of one shard into the results file of that shard.
+    :return: the results table of the shard, see `run`.
+    """
+    import pipeline
+
+    shard_symbols = list(pipeline.shard_stage(pipeline.symbols_stage(symbol_list), shard_index, shard_count))
+    if args.budget is not None:
+        args = argparse.Namespace(**dict(vars(args), budget=args.budget // shard_count))  # shards split the budget
+    args = argparse.Namespace(**dict(vars(args), export=[]))  # exported once every shard is merged
+    LOGGER.info("Shard %d/%d: valuing [%d] symbols.", shard_index, shard_count, len(shard_symbols))
+    results_path = paths.data_path(SHARD_RESULTS_FILE.format(date.today(), shard_index, shard_count), create_dir=True)
+    table = run(args, shard_symbols, rate_limiter, results_path)
+    if args.metrics:
+        root, extension = os.path.splitext(args.metrics)
+        report_metrics(f'{root}.shard-{shard_index}-of-{shard_count}{extension}')
+    return table
+
+
+def run_service(args):
+    """
+    Serves valuations on demand until interrupted, sharing one cache store and one rate budget between requests.
+    :param args: parsed command line arguments.
+    :return: void
+    """
+    from service.cache_store import CacheStore
+    from service.data_service import DataService
+    from service.http_client import HttpClient, TIMEOUT
+    from service.rate_limiter import TokenBucket
+    from service.valuation_service import ValuationCache, ValuationService, serve
+
+    METRICS.enable()  # served on /metrics
+    rate_limiter = TokenBucket(args.rate, args.burst)
+    http_client = HttpClient(timeout=(TIMEOUT[0], args.timeout), max_retries=args.retries,
+                             pool_size=args.max_in_flight, rate_limiter=rate_limiter)
+    data_service = DataService(rate_limiter, http_client=http_client)
+    service = ValuationService(CacheStore(), data_service, ValuationCache(args.max_entries, args.ttl))
+    serve(service, args.host, args.port)
+
+
+def report_metrics(metrics_path):
+    print(METRICS.summary())
+    METRICS.write_snapshot(metrics_path)
+
+
+def render_results(history, results_path, symbols=None, export_formats=()):
+    """
+    Renders today's results table from the history store and writes it to `results_path`,
+    and the raw results to one file per export format.
+    :param history: HistoryStore holding today's valuations.
+    :param results_path: results file to write.
+    :param symbols: symbols to render, every symbol valued today if None.
+    :param export_formats: formats of rendering.EXPORT_FORMATS to export the raw results to.
+    :return: the results table, headers included.
+    """
+    import rendering
+
+    columns = rendering.result_columns(history.read(date.today()), symbols)
+    table = rendering.format_table(columns)
+    utils.write_to_csv(table, results_path)
+    for export_format in export_formats:
+        rendering.export(columns, paths.data_path(EXPORT_FILE.format(date.today(), export_format)), export_format)
+    return table
+
+
+def merge_shards(export_formats=()):
+    from service.history_store import HistoryStore
+
+    with METRICS.timer('stage_seconds', stage='merge'):
+        history = HistoryStore()
+        history.compact(date.today())
+        results_path = paths.data_path(RESULTS_FILE.format(date.today()), create_dir=True)
+        return render_results(history, results_path, export_formats=export_formats)
+
+
+def show_symbols(args):
+    """
+    Runs the `symbols` command: prints the universe, what an update changed in it or its past changes.
+    :param args: parsed command line arguments.
+    :return: void
+    """
+    from service.symbol_getter import Universe, update_symbols
+
+    universe = Universe()
+    if args.update:
+        diff = update_symbols(universe, args.refresh_index)
+        print('\n'.join([f'+{symbol}' for symbol in diff['added']] + [f'-{symbol}' for symbol in diff['removed']]))
+    elif args.changes is not None:
+        for change in universe.changes(utils.parse_date(args.changes) if args.changes else None):
+            print(f"{change['date']}: {change['size']} symbols, +{len(change['added'])} {' '.join(change['added'])}, "
+                  f"-{len(change['removed'])} {' '.join(change['removed'])}")
+    else:
+        symbols = universe.load()
+        print('\n'.join(symbols))
+        LOGGER.info("[%d] symbols in %s", len(symbols), universe.symbols_path)
+
+
+def query_cache(args):
+    """
+    Runs the `cache` command: prints the cached valuation of some symbols, without any network call.
+    Only the cache store and the Stock record are imported, so the command starts in a few tens of milliseconds.
+    :param args: parsed command line arguments.
+    :return: void
+    """
+    import json
+    from service.cache_store import CacheStore
+    from service.symbol_getter import normalize_symbol
+    from stock import Stock
+
+    cache_store = CacheStore()
+    cache_store.close()  # only read
+    if not args.symbols:
+        print(f'{len(cache_store)} symbols cached in {cache_store.cache_file}')
+        return
+
+    for symbol in args.symbols:
+        symbol = normalize_symbol(symbol) or symbol.strip().upper()
+        row = cache_store.find(symbol)
+        record = Stock.from_row(row).get_as_record() if row is not None else None
+        if args.json:
+            print(json.dumps(record if record is not None else {'symbol': symbol}, separators=(',', ':')))
+        elif record is None:
+            print(f'{symbol:<8} not cached')
+        else:
+            current_to_fair = utils.MISSING_VALUE if record['current_to_fair'] is None else f"{record['current_to_fair']:.0%}"
+            print(f"{record['symbol']:<8} {(record['name'] or '')[:30]:<30} "
+                  f"price {utils.format_currency(record['current_price']):>12}  "
+                  f"fair {utils.format_currency(record['fair_price']):>12}  {current_to_fair:>5}  "
+                  f"expires {row['expires_on']}")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.data_dir:
+        os.environ[paths.DATA_DIR_ENV] = args.data_dir  # inherited by worker processes
+    args.func(args)
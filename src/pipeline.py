@@ -0,0 +1,191 @@
+import csv
+import logging
+import math
+import os
+import zlib
+from time import perf_counter
+
+from rendering import RESULT_HEADERS
+from service.symbol_getter import normalize_symbol
+from stock import Stock
+from utils.metrics import METRICS
+from service.data_service import MAX_IN_FLIGHT
+from valuation import growth
+from valuation.model import EPS_GROWTH_SHARE
+
+FETCH_BATCH_SIZE = 50  # symbols fetched and valued per batch, bounds what is held in memory
+LOGGER = logging.getLogger(__name__)
+
+# A run is a chain of generator stages: symbols -> fetch -> value -> sink. Every symbol flows through the whole
+# chain, one batch at a time, so results are written as soon as they are valued.
+
+
+def symbols_stage(symbol_list, completed=()):
+    """
+    Yields every symbol once, normalized like 'BRK-B', skipping the ones completed by a previous run.
+    :param symbol_list: symbols to value.
+    :param completed: symbols to skip.
+    :return: generator of symbols.
+    """
+    seen = set(completed)
+    for symbol in symbol_list:
+        symbol = normalize_symbol(symbol)
+        if symbol and symbol not in seen:
+            seen.add(symbol)
+            yield symbol
+
+
+def shard_stage(symbols, shard_index, shard_count):
+    """
+    Keeps the symbols of one shard. Symbols are assigned by a hash of their name, so a symbol stays in the same
+    shard on every machine and when other symbols are added to or removed from the universe.
+    :param symbols: symbols to split.
+    :param shard_index: shard to keep, from 0 to shard_count - 1.
+    :param shard_count: number of shards.
+    :return: generator of the symbols of the shard.
+    """
+    for symbol in symbols:
+        if zlib.crc32(symbol.encode('utf-8')) % shard_count == shard_index:
+            yield symbol
+
+
+def fetch_stage(symbols, cache_store, data_service, use_async=False, max_in_flight=MAX_IN_FLIGHT,
+                batch_size=FETCH_BATCH_SIZE):
+    """
+    Fetches, in batches, the data of the symbols missing from the cache, before any stock of the batch is valued.
+    In async mode every batch is fetched concurrently. The data is kept by `data_service` until the stock is valued.
+    :param symbols: symbols to fetch.
+    :param cache_store: CacheStore to check before fetching.
+    :param data_service: DataService to fetch data with.
+    :param use_async: fetch every batch concurrently.
+    :param max_in_flight: maximum number of concurrent requests in async mode.
+    :param batch_size: number of symbols per batch.
+    :return: generator of lists of symbols whose data is available.
+    """
+    batch = []
+    for symbol in symbols:
+        batch.append(symbol)
+        if len(batch) == batch_size:
+            yield fetch_batch(batch, cache_store, data_service, use_async, max_in_flight)
+            batch = []
+    if batch:
+        yield fetch_batch(batch, cache_store, data_service, use_async, max_in_flight)
+
+
+def fetch_batch(batch, cache_store, data_service, use_async, max_in_flight):
+    with METRICS.timer('stage_seconds', stage='prefetch'):
+        data_service.prefetch([symbol for symbol in batch if symbol not in cache_store], max_in_flight, use_async)
+    return batch
+
+
+def value_stage(batches, cache_store, data_service, quotes=None, fundamentals=None):
+    """
+    Values the stocks of every batch, from the cache or from the fetched data.
+    :param batches: lists of symbols from `fetch_stage`.
+    :param cache_store: CacheStore shared by every stock.
+    :param data_service: DataService holding the fetched data.
+    :param quotes: dictionary of symbol to latest price, for the stocks to reprice.
+    :param fundamentals: FundamentalsStore to estimate the EPS growth of every batch at once with, from every annual
+    period of the fetched earnings. Every stock estimates its own if None.
+    :return: generator of tuples (symbols in the batch, valued Stock objects in the batch).
+    """
+    quotes = quotes or {}
+    for batch in batches:
+        eps_next_5y = {}
+        if fundamentals is not None:
+            with METRICS.timer('stage_seconds', stage='growth'):
+                fundamentals.ingest(data_service.response_cache, batch)
+                expected = (growth.eps_growth(fundamentals.get('eps', batch)) * EPS_GROWTH_SHARE).tolist()
+            eps_next_5y = {symbol: value for symbol, value in zip(batch, expected) if not math.isnan(value)}
+        stocks = []
+        for symbol in batch:
+            start = perf_counter()
+            stock = Stock(symbol, eps_next_5y=eps_next_5y.get(symbol), cache_store=cache_store,
+                          data_service=data_service)
+            if stock.symbol in quotes:
+                stock.reprice(quotes[stock.symbol])
+            elapsed = perf_counter() - start
+            METRICS.observe('stage_seconds', elapsed, stage='value')
+            METRICS.observe_symbol(stock.symbol, elapsed)
+            if stock.fair_price is None:
+                LOGGER.info("Fair price for [%s] could not be determined. Skipping...", stock.symbol)
+                METRICS.count('symbols_total', result='skipped')
+            else:
+                stocks.append(stock)
+                METRICS.count('symbols_total', result='valued')
+        yield batch, stocks
+
+
+def group_stage(valued, min_stocks):
+    """
+    Merges consecutive valued batches until they hold at least `min_stocks` stocks, e.g. so that valuing their
+    scenarios keeps every worker busy. The last group may be smaller.
+    :param valued: tuples (symbols, stocks) from `value_stage`.
+    :param min_stocks: stocks per group.
+    :return: generator of tuples (symbols in the group, valued Stock objects in the group).
+    """
+    symbols, stocks = [], []
+    for batch, batch_stocks in valued:
+        symbols.extend(batch)
+        stocks.extend(batch_stocks)
+        if len(stocks) >= min_stocks:
+            yield symbols, stocks
+            symbols, stocks = [], []
+    if symbols:
+        yield symbols, stocks
+
+
+class ResultsSink:
+    """
+    Appends result rows to the results CSV file as soon as they are valued and records completed symbols
+    in a checkpoint file, so that an interrupted run can be resumed.
+    """
+
+    def __init__(self, results_path, headers=RESULT_HEADERS, resume=False):
+        self.results_path = results_path
+        self.checkpoint_path = f'{results_path}.checkpoint'
+        self.completed = set()
+        self.rows_written = 0
+
+        if resume and os.path.isfile(self.checkpoint_path):
+            with open(self.checkpoint_path, mode='r', encoding='utf-8') as f:
+                self.completed = {line.strip() for line in f if line.strip()}
+            LOGGER.info("Resuming run: [%d] symbols were already completed.", len(self.completed))
+        else:
+            resume = False
+
+        new_file = not resume or not os.path.isfile(self.results_path) or os.path.getsize(self.results_path) == 0
+        self.results_file = open(self.results_path, mode='w' if new_file else 'a', newline='', encoding='utf-8')
+        self.checkpoint_file = open(self.checkpoint_path, mode='a' if resume else 'w', encoding='utf-8')
+        self.writer = csv.writer(self.results_file)
+        if new_file:
+            self.writer.writerow(headers)
+            self.results_file.flush()
+
+    def write(self, symbols, rows):
+        """
+        Appends the rows of a batch to the results file, then marks every symbol of the batch as completed.
+        :param symbols: symbols processed in the batch, valued or not.
+        :param rows: result rows of the valued symbols.
+        :return: void
+        """
+        with METRICS.timer('stage_seconds', stage='write'):
+            self.writer.writerows(rows)
+            self.results_file.flush()
+            self.rows_written += len(rows)
+
+            self.checkpoint_file.writelines(f'{symbol}\n' for symbol in symbols)
+            self.checkpoint_file.flush()
+            self.completed.update(symbols)
+
+    def close(self):
+        self.results_file.close()
+        self.checkpoint_file.close()
+        LOGGER.info("[%d] rows written to results file: %s", self.rows_written, self.results_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
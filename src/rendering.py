@@ -0,0 +1,264 @@
+import csv
+import json
+import logging
+import math
+import os
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from utils import utils
+from valuation.growth import GROWTH_COLUMNS, GROWTH_HEADERS
+from valuation.scenarios import SCENARIO_COLUMNS, SCENARIO_HEADERS
+
+# raw result columns and the headers of their formatted version, in the same order
+RESULT_COLUMNS = ['symbol', 'name', 'market_cap', 'present_value', 'current_price', 'fair_price', 'price_to_book',
+                  'current_to_fair']
+RESULT_HEADERS = ['symbol', 'name', 'currentPrice', 'fairPrice', 'currentPricePerShare',
+                  'fairPricePerShare', 'priceToBookRatio', 'current/fair(%)']
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+CHUNK_ROWS = 10_000  # rows converted and written at once by the exporters
+LOGGER = logging.getLogger(__name__)
+
+# Results stay raw numbers until they are output: `result_columns` derives the result columns of a day of the
+# history store as arrays, `format_record` turns one result into display strings, and the exporters stream the raw
+# numbers to machine-readable files.
+
+
+def format_number(value, spec):
+    """
+    :param value: number to format, None or NaN for a missing value.
+    :param spec: format spec, e.g. '{:,.2f}'.
+    :return: the formatted number, or utils.MISSING_VALUE like the formatted amounts.
+    """
+    if value is None or math.isnan(value):
+        return utils.MISSING_VALUE
+    return spec.format(value)
+
+
+def format_record(record):
+    """
+    Formats a raw result for display, like '$1.23 B' or '85%'.
+    :param record: dictionary keyed by RESULT_COLUMNS, SCENARIO_COLUMNS if the stock was valued under scenarios,
+    and GROWTH_COLUMNS if its growth was estimated from its multi-year fundamentals.
+    :return: list of strings in the order of RESULT_HEADERS (+ SCENARIO_HEADERS) (+ GROWTH_HEADERS).
+    """
+    row = [record['symbol'], record['name'],
+           utils.format_currency(record['market_cap']),
+           utils.format_currency(record['present_value']),
+           utils.format_currency(record['current_price']),
+           utils.format_currency(record['fair_price']),
+           format_number(record['price_to_book'], '{:,.2f}'),
+           format_number(record['current_to_fair'], '{:,.0%}')]
+    if SCENARIO_COLUMNS[0] in record:
+        row.extend(utils.format_currency(record[column]) for column in SCENARIO_COLUMNS[:-1])
+        row.append(format_number(record[SCENARIO_COLUMNS[-1]], '{:,.0%}'))
+    if GROWTH_COLUMNS[0] in record:
+        row.extend(format_number(record[column], '{:,.1%}') for column in GROWTH_COLUMNS[:-1])
+        row.append(utils.format_currency(record[GROWTH_COLUMNS[-1]]))
+    return row
+
+
+def result_columns(columns, symbols=None):
+    """
+    Derives the raw result columns from the columns of a day of the history store.
+    The scenario columns are kept if any stock of the day has them, and so are the growth columns.
+    :param columns: columns returned by `HistoryStore.read`.
+    :param symbols: symbols to keep, every symbol if None.
+    :return: dictionary of RESULT_COLUMNS (+ SCENARIO_COLUMNS) (+ GROWTH_COLUMNS) to arrays.
+    """
+    if not columns:
+        return {column: np.array([], dtype=str if column in ('symbol', 'name') else np.float64)
+                for column in RESULT_COLUMNS}
+
+    keep = slice(None) if symbols is None else np.isin(columns['symbol'], list(symbols))
+
+    def column(name):
+        return np.asarray(columns[name][keep])
+
+    current_price = column('current_price')
+    fair_price = column('fair_price')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        current_to_fair = current_price / fair_price
+    result = {'symbol': column('symbol'), 'name': column('name'),
+              'market_cap': current_price * column('outstanding_shares'), 'present_value': column('present_value'),
+              'current_price': current_price, 'fair_price': fair_price, 'price_to_book': column('price_to_book'),
+              'current_to_fair': current_to_fair}
+    if all(name in columns for name in SCENARIO_COLUMNS) and not np.isnan(columns[SCENARIO_COLUMNS[-1]]).all():
+        result.update((name, column(name)) for name in SCENARIO_COLUMNS)
+    if all(name in columns for name in GROWTH_COLUMNS):
+        result.update((name, column(name)) for name in GROWTH_COLUMNS)
+    return result
+
+
+def iter_records(columns, start=0, stop=None):
+    """
+    Converts result columns to one dictionary per row, with Python floats and None for missing values.
+    :param columns: result columns from `result_columns`.
+    :return: generator of dictionaries.
+    """
+    stop = len(columns['symbol']) if stop is None else stop
+    values = [columns[name][start:stop].tolist() for name in columns]
+    for row in zip(*values):
+        yield {name: None if isinstance(value, float) and math.isnan(value) else value
+               for name, value in zip(columns, row)}
+
+
+def format_table(columns):
+    """
+    :param columns: result columns from `result_columns`.
+    :return: the results table for display, headers included.
+    """
+    headers = (RESULT_HEADERS + (SCENARIO_HEADERS if SCENARIO_COLUMNS[0] in columns else [])
+               + (GROWTH_HEADERS if GROWTH_COLUMNS[0] in columns else []))
+    return [headers] + [format_record(record) for record in iter_records(columns)]
+
+
+class Exporter(ABC):
+    """
+    Streams raw result columns to a file, chunk by chunk. The file is written to a temporary path and
+    only replaces `path` once complete.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f'{path}.{os.getpid()}.tmp'
+        self.rows_written = 0
+
+    @abstractmethod
+    def write(self, columns):
+        """
+        Writes a chunk of result columns.
+        :param columns: result columns from `result_columns`.
+        :return: void
+        """
+
+    @abstractmethod
+    def release(self):
+        """
+        Closes the temporary file.
+        :return: void
+        """
+
+    def close(self):
+        self.release()
+        os.replace(self.tmp_path, self.path)
+        LOGGER.info("[%d] rows exported to %s", self.rows_written, self.path)
+
+    def abort(self):
+        """
+        Closes and removes the temporary file, leaving `path` as it was.
+        :return: void
+        """
+        try:
+            self.release()
+        finally:
+            try:
+                os.remove(self.tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CsvExporter(Exporter):
+    """
+    CSV with a header row and numbers at full precision. Missing values are empty cells.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(self.tmp_path, mode='w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.has_header = False
+
+    def write(self, columns):
+        if not self.has_header:
+            self.writer.writerow(list(columns))
+            self.has_header = True
+        for record in iter_records(columns):
+            self.writer.writerow(['' if value is None else value for value in record.values()])
+            self.rows_written += 1
+
+    def release(self):
+        self.file.close()
+
+    def close(self):
+        if not self.has_header:
+            self.writer.writerow(RESULT_COLUMNS)
+        super().close()
+
+
+class JsonlExporter(Exporter):
+    """
+    One JSON object per line. Missing values are null.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(self.tmp_path, mode='w', encoding='utf-8')
+
+    def write(self, columns):
+        for record in iter_records(columns):
+            self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.rows_written += 1
+
+    def release(self):
+        self.file.close()
+
+
+class ParquetExporter(Exporter):
+    """
+    Parquet file with one row group per chunk. Needs pyarrow, which is only imported here.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as err:
+            raise RuntimeError("Parquet output needs pyarrow. Install it with 'pip install pyarrow'.") from err
+        self.pyarrow = pyarrow
+        self.writer = None
+
+    def write(self, columns):
+        table = self.pyarrow.table({name: np.asarray(values) for name, values in columns.items()})
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.tmp_path, table.schema)
+        self.writer.write_table(table)
+        self.rows_written += table.num_rows
+
+    def close(self):
+        if self.writer is None:  # nothing written, still leave a valid file
+            self.write({name: np.array([], dtype=str if name in ('symbol', 'name') else np.float64)
+                        for name in RESULT_COLUMNS})
+        super().close()
+
+    def release(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+EXPORTERS = {'csv': CsvExporter, 'jsonl': JsonlExporter, 'parquet': ParquetExporter}
+
+
+def export(columns, path, export_format, chunk_rows=CHUNK_ROWS):
+    """
+    Writes raw result columns to a machine-readable file, CHUNK_ROWS rows at a time.
+    :param columns: result columns from `result_columns`.
+    :param path: file to write.
+    :param export_format: one of EXPORT_FORMATS.
+    :param chunk_rows: rows per chunk.
+    :return: void
+    """
+    with EXPORTERS[export_format](path) as exporter:
+        for start in range(0, len(columns['symbol']), chunk_rows):
+            exporter.write({name: values[start:start + chunk_rows] for name, values in columns.items()})
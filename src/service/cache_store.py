@@ -0,0 +1,308 @@
+import atexit
+import csv
+import logging
+import os
+import threading
+import weakref
+from datetime import date, timedelta
+from time import monotonic
+
+from service.symbol_getter import normalize_symbol
+from utils import paths, utils
+from utils.file_lock import FileLock
+from utils.metrics import METRICS
+
+CACHE_FILE = 'cache.csv'  # in the data directory
+LAST_CACHE_DT_FILE = 'date_of_last_cache.txt'  # only read to migrate caches without 'expires_on'
+CACHE_USEFUL_LIFE = 30  # days
+FLUSH_ROWS = 100  # rows buffered before they are written to the cache file
+FLUSH_INTERVAL = 30  # seconds rows can stay buffered
+CACHE_HEADERS = ['symbol', 'name', 'fcc', 'cash', 'total_debt',
+                 'shares', 'beta', 'eps_next_5y', 'current_price',
+                 'fair_price', 'price_to_book', 'PV', 'model_version', 'expires_on']
+LOGGER = logging.getLogger(__name__)
+OPEN_STORES = weakref.WeakSet()  # stores flushed at exit, without keeping them alive
+
+
+@atexit.register
+def flush_open_stores():
+    for store in list(OPEN_STORES):
+        store.flush()
+
+
+def cache_key(symbol):
+    """
+    :return: the key of a symbol in the cache: the normalized symbol, e.g. 'BRK-B' for 'brk.b', or the upper-case
+    symbol if it isn't a valid one.
+    """
+    return normalize_symbol(symbol) or symbol.strip().upper()
+
+
+class CacheStore:
+    """
+    Symbol-keyed index over the cache CSV file. The file is parsed once, when the store is created,
+    and every row carries its own expiry date, so entries expire one symbol at a time.
+    Every access to the file holds an inter-process lock, so several processes can share the cache, and every access
+    to the index and the buffer holds a thread lock, so the threads of a process can share the store.
+    New rows are written behind: they are buffered and flushed in batches, every FLUSH_ROWS rows, after FLUSH_INTERVAL
+    seconds and at exit. Every flush replaces the file atomically, so readers never see a partial row.
+    Close the store, or use it as a context manager, when done with it. Long-running processes should call
+    `flush_if_due` periodically so that rows don't stay buffered while no row is appended.
+    """
+
+    def __init__(self, cache_file=None, last_cache_dt_file=None, flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL):
+        """
+        :param cache_file: cache CSV file, CACHE_FILE in the data directory if None.
+        :param last_cache_dt_file: legacy cache date file, LAST_CACHE_DT_FILE in the data directory if None.
+        """
+        self.cache_file = cache_file if cache_file is not None else paths.data_path(CACHE_FILE, create_dir=True)
+        self.last_cache_dt_file = (last_cache_dt_file if last_cache_dt_file is not None
+                                   else paths.data_path(LAST_CACHE_DT_FILE))
+        self.lock = FileLock(f'{self.cache_file}.lock')
+        self.rows_lock = threading.RLock()  # guards `rows` and `pending`
+        self.flush_lock = threading.Lock()  # one flush at a time, so older rows never overwrite newer ones
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.rows = {}
+        self.pending = {}  # rows not written yet, by symbol
+        self.flushed_at = monotonic()
+        self.load()
+        OPEN_STORES.add(self)
+
+    def load(self):
+        """
+        Reads the whole cache file into the index. Expired rows are dropped and, for symbols cached more than once,
+        the last row wins. The file is rewritten when it needs compacting or doesn't have the current headers.
+        :return: void
+        """
+        with METRICS.timer('cache_load_seconds'), self.lock:
+            if self.read():
+                self.rewrite()
+        LOGGER.info("Loaded [%d] symbols from cache.", len(self.rows))
+
+    def read(self):
+        """
+        Replaces the index with the rows of the cache file. The caller must hold the lock.
+        :return: True if the file needs rewriting, False otherwise.
+        """
+        self.rows, needs_rewrite = self.read_rows()
+        return needs_rewrite
+
+    def read_rows(self):
+        """
+        Reads the rows of the cache file, without the expired ones. The caller must hold the lock.
+        :return: tuple (dictionary of symbol to row, True if the file needs rewriting).
+        """
+        rows = {}
+        if not os.path.isfile(self.cache_file) or os.path.getsize(self.cache_file) == 0:
+            LOGGER.info("Cache file didn't exist or was empty. It was set to have headers only.")
+            return rows, True
+
+        today = date.today()
+        needs_rewrite = False
+        with open(self.cache_file, mode='r', newline='', encoding='utf-8') as csv_file:
+            csv_reader = csv.DictReader(csv_file)
+            if csv_reader.fieldnames != CACHE_HEADERS:
+                needs_rewrite = True
+            legacy_expiry = None
+            for row in csv_reader:
+                if None in row.values():  # a row cut short by a crash while appending, before writes were atomic
+                    LOGGER.warning("Dropping truncated cache row: %s", row)
+                    needs_rewrite = True
+                    continue
+                symbol = cache_key(row['symbol'])
+                if symbol != row['symbol']:  # cached before symbols were normalized, e.g. 'BRK.B'
+                    row['symbol'] = symbol
+                    needs_rewrite = True
+                if row.get('expires_on'):
+                    expires_on = utils.parse_date(row['expires_on'])
+                else:
+                    if legacy_expiry is None:
+                        legacy_expiry = self.get_legacy_expiry()
+                    expires_on = legacy_expiry
+                    row['expires_on'] = str(expires_on)
+
+                needs_rewrite = needs_rewrite or symbol in rows
+                if expires_on < today:
+                    needs_rewrite = True
+                    rows.pop(symbol, None)
+                    continue
+                rows[symbol] = row
+
+        return rows, needs_rewrite
+
+    def get_legacy_expiry(self):
+        """
+        Expiry date of rows written before rows had their own, based on the date of the last cache.
+        :return: date the legacy rows expire on.
+        """
+        try:
+            with open(self.last_cache_dt_file, mode='r', newline='', encoding='utf-8') as f:
+                latest_cache = utils.parse_date(f.read().strip())
+        except (OSError, ValueError):
+            return date.today() - timedelta(days=1)
+        return latest_cache + timedelta(days=CACHE_USEFUL_LIFE)
+
+    def rewrite(self, rows=None):
+        """
+        Writes the headers and the rows to a temporary file, then replaces the cache file with it,
+        so that readers see either the old or the new file. The caller must hold the lock.
+        :param rows: dictionary of symbol to row to write, the index if None.
+        :return: void
+        """
+        rows = self.rows if rows is None else rows
+        tmp_path = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp_path, mode='w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=CACHE_HEADERS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows.values())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.cache_file)
+
+    def get(self, symbol):
+        """
+        Looks up the cached row of a symbol, counting hits and misses.
+        :param symbol: stock symbol to look up.
+        :return: the row as a dictionary keyed by CACHE_HEADERS, or None if it isn't cached or has expired.
+        """
+        row = self.find(symbol)
+        METRICS.count('cache_total', result='miss' if row is None else 'hit')
+        return row
+
+    def find(self, symbol):
+        """
+        Same as `get`, for membership checks that shouldn't count as lookups.
+        """
+        symbol = cache_key(symbol)
+        with self.rows_lock:
+            row = self.rows.get(symbol)
+            if row is None:
+                return None
+            if utils.parse_date(row['expires_on']) >= date.today():
+                return row
+            del self.rows[symbol]
+        LOGGER.info("Cached data for [%s] expired on %s.", symbol, row['expires_on'])
+        METRICS.count('cache_expired_total')
+        return None
+
+    def put(self, row, ttl_days=CACHE_USEFUL_LIFE):
+        """
+        Adds or replaces the cached row of a symbol and appends it to the cache file.
+        :param row: dictionary keyed by CACHE_HEADERS. 'expires_on' is set from `ttl_days`.
+        :param ttl_days: number of days the row stays fresh.
+        :return: void
+        """
+        row = dict(row, symbol=cache_key(row['symbol']), expires_on=str(date.today() + timedelta(days=ttl_days)))
+        self.append(row)
+        self.flush_if_due()
+
+    def update(self, symbol, fields):
+        """
+        Updates some fields of the cached row of a symbol, keeping its expiry date, and appends it to the cache file.
+        :param symbol: stock symbol to update.
+        :param fields: dictionary of the fields to update, keyed by CACHE_HEADERS.
+        :return: void
+        """
+        symbol = cache_key(symbol)
+        with self.rows_lock:
+            self.append(dict(self.rows[symbol], **fields))
+        self.flush_if_due()
+
+    def append(self, row):
+        """
+        Indexes a row and buffers it for the cache file. Rows appended later win over earlier rows of the same symbol.
+        Call `flush_if_due` afterwards, without holding `rows_lock`: a flush takes `flush_lock` before `rows_lock`.
+        :param row: dictionary keyed by CACHE_HEADERS.
+        :return: void
+        """
+        with self.rows_lock:
+            self.rows[row['symbol']] = row
+            self.pending[row['symbol']] = row
+
+    def flush_if_due(self):
+        """
+        Flushes the buffered rows if there are FLUSH_ROWS of them or the last flush is FLUSH_INTERVAL seconds old.
+        :return: void
+        """
+        with self.rows_lock:
+            due = len(self.pending) >= self.flush_rows or monotonic() - self.flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows to the cache file in one atomic replacement. Rows written by other processes
+        since the store was loaded are kept.
+        :return: void
+        """
+        with self.flush_lock:
+            self.flushed_at = monotonic()
+            with self.rows_lock:  # rows appended from now on go to the next flush
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            try:
+                with METRICS.timer('stage_seconds', stage='cache_flush'), self.lock:
+                    rows = self.read_rows()[0]
+                    rows.update(pending)
+                    self.rewrite(rows)
+            except BaseException:
+                with self.rows_lock:  # keep the rows for the next flush, behind any newer row of the same symbol
+                    self.pending = dict(pending, **self.pending)
+                raise
+        LOGGER.debug("Flushed [%d] rows to the cache file.", len(pending))
+
+    def close(self):
+        """
+        Flushes the buffered rows. The store isn't flushed at exit anymore.
+        :return: void
+        """
+        self.flush()
+        OPEN_STORES.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def update_many(self, updates):
+        """
+        Updates some fields of the cached rows of many symbols, keeping their expiry dates,
+        and rewrites the cache file once. Rows written by other processes since the store was loaded are kept.
+        :param updates: dictionary of symbol to the dictionary of fields to update for it.
+        :return: void
+        """
+        with self.flush_lock, self.rows_lock, self.lock:
+            pending = self.pending
+            self.read()
+            self.rows.update(pending)
+            self.pending = {}
+            for symbol, fields in updates.items():
+                symbol = cache_key(symbol)
+                if symbol in self.rows:
+                    self.rows[symbol] = dict(self.rows[symbol], **fields)
+            self.rewrite()
+
+    def snapshot(self):
+        """
+        :return: list of the cached rows, safe to iterate while other threads use the store.
+        """
+        with self.rows_lock:
+            return list(self.rows.values())
+
+    def evict(self, symbol):
+        """
+        Drops a symbol from the index, so that it is fetched again. Its row stays in the file until it is replaced.
+        :param symbol: stock symbol to drop.
+        :return: void
+        """
+        with self.rows_lock:
+            self.rows.pop(cache_key(symbol), None)
+
+    def __contains__(self, symbol):
+        return self.find(symbol) is not None
+
+    def __len__(self):
+        return len(self.rows)
@@ -1,44 +1,95 @@
+import asyncio
 import logging
-import requests
+from concurrent.futures import ThreadPoolExecutor
+
+from service.http_client import HttpClient, ResponseError
+from service.rate_limiter import TokenBucket
+from service.response_cache import ResponseCache
 from utils import utils
-from utils.api_function_enum import ApiFunction
+from utils.api_function_enum import ApiFunction, BULK_QUOTES_MAX_SYMBOLS, get_bulk_quotes_url
+from utils.metrics import METRICS
 
 
+MAX_IN_FLIGHT = 16  # concurrent requests in async mode
 LOGGER = logging.getLogger(__name__)
 
 
 class DataService:
     """
     A service class to fetch stock data from the Alpha Vantage API.
+    One instance is meant to be shared by the whole run so that its rate limiter covers every request.
     """
 
-    def __init__(self):
-        self.request_count = 0
+    def __init__(self, rate_limiter=None, response_cache=None, http_client=None):
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket()
+        self.response_cache = response_cache if response_cache is not None else ResponseCache()
+        self.http_client = http_client if http_client is not None else HttpClient(rate_limiter=self.rate_limiter)
+        self.prefetched = {}
+        self.bulk_quotes_available = True
 
-    def fetch_data(self, func: ApiFunction, symbol: str):
+    def fetch_data(self, func: ApiFunction, symbol: str, use_cache=True):
         """
-        Fetches data from the Alpha Vantage API for a given function and stock symbol.
+        Fetches data from the Alpha Vantage API for a given function and stock symbol,
+        or from the response cache if it holds a fresh response.
         :param func: endpoint function to fetch data from.
         :param symbol: stock to fetch data for.
+        :param use_cache: whether to look up the response cache before sending the request.
         :return: A JSON object containing the fetched data or None if the request fails.
         """
-        function_name = func.get_json_name()
-        url = func.get_url().format(symbol)
-        LOGGER.info("Fetching data for [%s] from '%s' endpoint...", symbol, function_name)
+        if use_cache:
+            data = self.response_cache.get(func, symbol)
+            if data is not None:
+                LOGGER.debug("Using cached '%s' response for [%s].", func.get_json_name(), symbol)
+                return data
 
-        if self.request_count == 74:
-            utils.take_break()
-            self.request_count = 0
-        self.request_count += 1
+        self.rate_limiter.acquire()
+        data = self.request(func, symbol)
+        self.response_cache.put(func, symbol, data)
+        return data
 
-        response = requests.get(url)
-        if response.status_code != 200:
-            LOGGER.warning("Error fetching data from '%s' endpoint: %d", function_name, response.status_code)
-            return None
+    async def fetch_data_async(self, func: ApiFunction, symbol: str, executor=None):
+        """
+        Async version of `fetch_data`. The blocking request runs in `executor`.
+        :param func: endpoint function to fetch data from.
+        :param symbol: stock to fetch data for.
+        :param executor: executor to run the request in. The loop's default executor if None.
+        :return: A JSON object containing the fetched data or None if the request fails.
+        """
+        data = self.response_cache.get(func, symbol)
+        if data is not None:
+            LOGGER.debug("Using cached '%s' response for [%s].", func.get_json_name(), symbol)
+            return data
+
+        await self.rate_limiter.acquire_async()
+        data = await asyncio.get_running_loop().run_in_executor(executor, self.request, func, symbol)
+        self.response_cache.put(func, symbol, data)
+        return data
+
+    def request(self, func: ApiFunction, symbol: str):
+        """
+        Sends a single request to the Alpha Vantage API, without rate limiting.
+        :param func: endpoint function to fetch data from.
+        :param symbol: stock to fetch data for.
+        :return: A JSON object containing the fetched data or None if the request fails.
+        """
+        with METRICS.timer('request_seconds', endpoint=func.get_url_name()):
+            return self.get_json(func.get_url().format(symbol), func.get_json_name(), symbol)
+
+    def get_json(self, url, function_name, symbol, raise_errors=False):
+        """
+        Sends a GET request through the pooled HTTP client and decodes its JSON body.
+        :param url: URL to request.
+        :param function_name: name of the endpoint, for logging.
+        :param symbol: stock (or comma-separated stocks) the request is for, for logging.
+        :param raise_errors: raise ResponseError when the API answers with an error, see `HttpClient.get_json`.
+        :return: A JSON object containing the fetched data or None if the request fails.
+        """
+        LOGGER.info("Fetching data for [%s] from '%s' endpoint...", symbol, function_name)
 
-        data = response.json()
+        data = self.http_client.get_json(url, raise_errors)
         if not data:
-            LOGGER.warning("Request was successful, but no data was returned. Symbol [%s] is probably de-listed or traded over the counter.", symbol)
+            LOGGER.warning("No data was returned from '%s' endpoint. Symbol [%s] is probably de-listed or traded over the counter.", function_name, symbol)
+            METRICS.count('failures_total', reason='empty_response')
             return None
 
         LOGGER.info("Request was successful")
@@ -46,13 +97,38 @@ class DataService:
 
     def fetch_all_data(self, symbol):
         """
-        Fetches all relevant data for the given symbol from the Alpha Vantage API.
+        Fetches all relevant data for the given symbol from the Alpha Vantage API,
+        unless it was already fetched by `prefetch`.
+        :param symbol: The stock symbol to fetch data for.
+        :return: A dictionary containing the fetched data or None if any data is missing.
+        """
+        if symbol in self.prefetched:
+            return self.prefetched.pop(symbol)
+
+        responses = {func: self.fetch_data(func, symbol) for func in ApiFunction}
+        return self.parse_all_data(symbol, responses)
+
+    async def fetch_all_data_async(self, symbol, executor=None):
+        """
+        Async version of `fetch_all_data`: requests to all the endpoints are in flight at the same time.
         :param symbol: The stock symbol to fetch data for.
+        :param executor: executor to run the requests in.
+        :return: A dictionary containing the fetched data or None if any data is missing.
+        """
+        functions = list(ApiFunction)
+        responses = await asyncio.gather(*(self.fetch_data_async(func, symbol, executor) for func in functions))
+        return self.parse_all_data(symbol, dict(zip(functions, responses)))
+
+    @staticmethod
+    def parse_all_data(symbol, responses):
+        """
+        Extracts the relevant part of the response of every endpoint.
+        :param symbol: The stock symbol the data was fetched for.
+        :param responses: dictionary of ApiFunction to the JSON object returned by `fetch_data`.
         :return: A dictionary containing the fetched data or None if any data is missing.
         """
         data = {}
-        for func in ApiFunction:
-            response = self.fetch_data(func, symbol)
+        for func, response in responses.items():
             if response is None or not isinstance(response, dict):
                 continue
             match func:
@@ -67,6 +143,126 @@ class DataService:
 
         if len(data) != len(ApiFunction):
             LOGGER.warning("Failed to fetch all necessary data for symbol: %s", symbol)
+            METRICS.count('failures_total', reason='missing_data')
             return None
 
         return data
+
+    def fetch_quotes(self, symbols):
+        """
+        Fetches the latest price of many symbols with as few requests as possible: fresh quotes come from the
+        response cache, the rest from the bulk quotes endpoint in batches of BULK_QUOTES_MAX_SYMBOLS,
+        and whatever the bulk endpoint didn't return from the GLOBAL_QUOTE endpoint one symbol at a time.
+        :param symbols: stock symbols to fetch the price of.
+        :return: A dictionary of symbol to its latest price. Symbols whose price couldn't be fetched are left out.
+        """
+        quotes = {}
+        missing = []
+        for symbol in symbols:
+            price = self.parse_quote(self.response_cache.get(ApiFunction.GLOBAL_QUOTE, symbol))
+            if price is None:
+                missing.append(symbol)
+            else:
+                quotes[symbol] = price
+
+        for i in range(0, len(missing), BULK_QUOTES_MAX_SYMBOLS):
+            if not self.bulk_quotes_available:
+                break
+            quotes.update(self.fetch_bulk_quotes(missing[i:i + BULK_QUOTES_MAX_SYMBOLS]))
+
+        for symbol in missing:
+            if symbol not in quotes:
+                price = self.parse_quote(self.fetch_data(ApiFunction.GLOBAL_QUOTE, symbol, use_cache=False))
+                if price is not None:
+                    quotes[symbol] = price
+
+        LOGGER.info("Fetched prices for [%d] of [%d] symbols.", len(quotes), len(symbols))
+        return quotes
+
+    def fetch_bulk_quotes(self, symbols):
+        """
+        Fetches the latest price of up to BULK_QUOTES_MAX_SYMBOLS symbols in a single request.
+        Every price is also stored in the response cache as a GLOBAL_QUOTE response.
+        :param symbols: stock symbols to fetch the price of.
+        :return: A dictionary of symbol to its latest price. Empty if the endpoint isn't available, which stops
+        any further bulk request, or if the request failed, which only affects these symbols.
+        """
+        self.rate_limiter.acquire()
+        joined_symbols = ','.join(symbols)
+        try:
+            with METRICS.timer('request_seconds', endpoint='bulk_quotes'):
+                data = self.get_json(get_bulk_quotes_url().format(joined_symbols), 'bulk_quotes', joined_symbols,
+                                     raise_errors=True)
+        except ResponseError as err:  # e.g. the endpoint isn't part of the plan
+            data = err
+        if data is None:  # timeouts or server errors until the retries ran out, the next batch may succeed
+            LOGGER.warning("Bulk quotes request failed. Falling back to one request per symbol for [%d] symbols.",
+                           len(symbols))
+            return {}
+        if not isinstance(data, dict) or not isinstance(data.get('data'), list):
+            LOGGER.warning("Bulk quotes are not available. Falling back to one request per symbol. Response: %s", data)
+            self.bulk_quotes_available = False
+            return {}
+
+        quotes = {}
+        for quote in data['data']:
+            try:
+                symbol = quote['symbol'].upper()
+                price = utils.safe_float(quote['close'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            quotes[symbol] = price
+            self.response_cache.put(ApiFunction.GLOBAL_QUOTE, symbol,
+                                    {'Global Quote': {'01. symbol': symbol, '05. price': quote['close']}})
+        return quotes
+
+    @staticmethod
+    def parse_quote(response):
+        """
+        Extracts the price from a GLOBAL_QUOTE response.
+        :param response: JSON object returned by the GLOBAL_QUOTE endpoint, or None.
+        :return: the price as a float, or None if the response doesn't have one.
+        """
+        try:
+            return utils.safe_float(response['Global Quote']['05. price'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    async def fetch_many_async(self, symbols, max_in_flight=MAX_IN_FLIGHT):
+        """
+        Fetches all relevant data for many symbols, keeping up to `max_in_flight` requests in flight
+        across symbols and endpoints. Throughput is bounded by the rate limiter, not by round-trips.
+        :param symbols: stock symbols to fetch data for.
+        :param max_in_flight: maximum number of concurrent requests.
+        :return: A dictionary of symbol to the result of `fetch_all_data` for that symbol.
+        """
+        # every symbol holds up to len(ApiFunction) requests, so this bounds the symbols in progress
+        symbols_in_progress = asyncio.Semaphore(max(1, max_in_flight // len(ApiFunction)))
+
+        async def fetch(symbol):
+            async with symbols_in_progress:
+                try:
+                    return await self.fetch_all_data_async(symbol, executor)
+                except (KeyError, IndexError, ValueError) as err:
+                    LOGGER.error("[%s] Unexpected response: %s", symbol, err)
+                    return None
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            results = await asyncio.gather(*(fetch(symbol) for symbol in symbols))
+        return dict(zip(symbols, results))
+
+    def prefetch(self, symbols, max_in_flight=MAX_IN_FLIGHT, use_async=True):
+        """
+        Fetches all relevant data for many symbols concurrently and keeps it for `fetch_all_data`.
+        :param symbols: stock symbols to fetch data for.
+        :param max_in_flight: maximum number of concurrent requests.
+        :param use_async: fetch concurrently, one symbol after the other if False.
+        :return: void
+        """
+        if not symbols:
+            return
+        if not use_async:
+            self.prefetched.update((symbol, self.fetch_all_data(symbol)) for symbol in symbols)
+            return
+        LOGGER.info("Prefetching data for [%d] symbols with up to %d requests in flight...", len(symbols), max_in_flight)
+        self.prefetched.update(asyncio.run(self.fetch_many_async(list(symbols), max_in_flight)))
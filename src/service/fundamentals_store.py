@@ -0,0 +1,169 @@
+import logging
+import os
+
+import numpy as np
+
+from utils import paths
+from utils.api_function_enum import ApiFunction
+from utils.file_lock import FileLock
+from valuation.growth import pad
+from valuation.revalue import to_float
+
+FUNDAMENTALS_FILE = 'fundamentals.npz'  # in the data directory
+# annual fields kept for every company: (endpoint, list of annual periods in its response, key of the value)
+FIELDS = {
+    'operating_cash_flow': (ApiFunction.CASH_FLOW, 'annualReports', 'operatingCashflow'),
+    'capital_expenditures': (ApiFunction.CASH_FLOW, 'annualReports', 'capitalExpenditures'),
+    'cash': (ApiFunction.BALANCE_SHEET, 'annualReports', 'cashAndShortTermInvestments'),
+    'total_debt': (ApiFunction.BALANCE_SHEET, 'annualReports', 'shortLongTermDebtTotal'),
+    'shares': (ApiFunction.BALANCE_SHEET, 'annualReports', 'commonStockSharesOutstanding'),
+    'eps': (ApiFunction.EARNINGS, 'annualEarnings', 'reportedEPS'),
+}
+ENDPOINTS = list(dict.fromkeys(func for func, _, _ in FIELDS.values()))
+LOGGER = logging.getLogger(__name__)
+
+
+class FundamentalsStore:
+    """
+    Multi-year annual fundamentals of every company, as padded arrays: one row per symbol and one column per
+    fiscal year, oldest first, NaN for the years a company has no value for. Every year between the first and the last
+    one has a column, even if no company has a value for it, as the growth estimators expect.
+    The statements and earnings responses already hold every annual period, so the store is filled from the
+    response cache without any request, and a response is only parsed again once it has been refreshed.
+    A refreshed response updates the years it holds and keeps the older ones.
+    The store is one .npz file, written atomically under an inter-process lock and merged with what other
+    processes saved in the meantime.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: store file, FUNDAMENTALS_FILE in the data directory if None.
+        """
+        self.path = path if path is not None else paths.data_path(FUNDAMENTALS_FILE, create_dir=True)
+        self.lock = FileLock(f'{self.path}.lock')
+        self.symbols = []
+        self.index = {}
+        self.years = np.array([], dtype=np.int64)
+        self.fields = {field: np.empty((0, 0)) for field in FIELDS}
+        self.ingested_at = np.array([])  # latest modification time of the responses a row was parsed from
+        self.changed = False
+        self.merge(*self.read())
+
+    def read(self):
+        """
+        :return: tuple (symbols, years, dictionary of field to array, ingested_at) of the store file,
+        empty if there is no file.
+        """
+        if not os.path.isfile(self.path):
+            return [], np.array([], dtype=np.int64), {field: np.empty((0, 0)) for field in FIELDS}, np.array([])
+        with np.load(self.path) as data:
+            return (data['symbol'].tolist(), data['year'], {field: data[field] for field in FIELDS},
+                    data['ingested_at'])
+
+    def merge(self, symbols, years, fields, ingested_at):
+        """
+        Merges rows into the store. A row replaces the values of the store for the years it has a value for,
+        if it was parsed from newer responses than the row of the store.
+        :param symbols: symbols of the rows.
+        :param years: sorted fiscal years of the columns of the rows.
+        :param fields: dictionary of field to array of shape (len(symbols), len(years)).
+        :param ingested_at: modification time of the responses every row was parsed from.
+        :return: the number of rows merged.
+        """
+        all_years = np.union1d(self.years, years)
+        if len(all_years):
+            all_years = np.arange(all_years[0], all_years[-1] + 1, dtype=np.int64)
+        if len(all_years) > len(self.years):
+            columns = np.searchsorted(all_years, self.years)
+            for field, values in self.fields.items():
+                widened = np.full((len(values), len(all_years)), np.nan)
+                widened[:, columns] = values
+                self.fields[field] = widened
+            self.years = all_years
+
+        new_symbols = [symbol for symbol in dict.fromkeys(symbols) if symbol not in self.index]
+        if new_symbols:
+            self.index.update((symbol, len(self.symbols) + i) for i, symbol in enumerate(new_symbols))
+            self.symbols.extend(new_symbols)
+            for field, values in self.fields.items():
+                self.fields[field] = np.vstack([values, np.full((len(new_symbols), len(self.years)), np.nan)])
+            self.ingested_at = np.concatenate([self.ingested_at, np.full(len(new_symbols), -np.inf)])
+
+        rows = np.array([self.index[symbol] for symbol in symbols], dtype=np.intp)
+        newer = np.asarray(ingested_at, dtype=np.float64) > self.ingested_at[rows]
+        rows = rows[newer]
+        cells = np.ix_(rows, np.searchsorted(self.years, years))
+        for field, values in fields.items():
+            incoming = values[newer]
+            self.fields[field][cells] = np.where(np.isnan(incoming), self.fields[field][cells], incoming)
+        self.ingested_at[rows] = np.asarray(ingested_at, dtype=np.float64)[newer]
+        return len(rows)
+
+    def ingest(self, response_cache, symbols):
+        """
+        Adds the annual periods of the cached responses of symbols, skipping the symbols whose responses
+        haven't changed since they were last ingested.
+        :param response_cache: ResponseCache holding the statements and earnings of the symbols.
+        :param symbols: stock symbols.
+        :return: the number of symbols ingested.
+        """
+        parsed = []
+        for symbol in dict.fromkeys(symbols):
+            mtimes = [response_cache.get_mtime(func, symbol) for func in ENDPOINTS]
+            mtime = max((mtime for mtime in mtimes if mtime is not None), default=None)
+            row = self.index.get(symbol)
+            if mtime is None or (row is not None and mtime <= self.ingested_at[row]):
+                continue
+            responses = {func: response_cache.read(func, symbol) or {} for func in ENDPOINTS}
+            periods = {}
+            for field, (func, reports_key, value_key) in FIELDS.items():
+                periods[field] = {}
+                for report in responses[func].get(reports_key) or []:
+                    try:
+                        year = int(report['fiscalDateEnding'][:4])
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    periods[field].setdefault(year, to_float(report.get(value_key)))  # most recent report first
+            parsed.append((symbol, mtime, periods))
+        if not parsed:
+            return 0
+
+        years = np.array(sorted({year for _, _, periods in parsed for series in periods.values() for year in series}),
+                         dtype=np.int64)
+        fields = {field: pad([periods[field] for _, _, periods in parsed], years) for field in FIELDS}
+        ingested = self.merge([symbol for symbol, _, _ in parsed], years, fields, [mtime for _, mtime, _ in parsed])
+        self.changed = self.changed or ingested > 0
+        LOGGER.debug("Ingested the fundamentals of [%d] symbols.", ingested)
+        return ingested
+
+    def get(self, field, symbols):
+        """
+        :param field: one of FIELDS, or 'free_cash_flow' for the operating cash flow minus the capital expenditures.
+        :param symbols: stock symbols.
+        :return: float64 array of shape (len(symbols), len(years)), in the order of `symbols`, NaN for the years
+        a company has no value for and for the symbols not in the store.
+        """
+        if field == 'free_cash_flow':
+            return self.get('operating_cash_flow', symbols) - self.get('capital_expenditures', symbols)
+        rows = np.array([self.index.get(symbol, -1) for symbol in symbols], dtype=np.intp)
+        values = self.fields[field][np.maximum(rows, 0)] if len(self.symbols) else np.full((len(rows), 0), np.nan)
+        values[rows < 0] = np.nan
+        return values
+
+    def save(self):
+        """
+        Merges the store file, which other processes may have saved since it was read, and writes the result
+        atomically. Nothing is written if nothing was ingested.
+        :return: void
+        """
+        if not self.changed:
+            return
+        with self.lock:
+            self.merge(*self.read())
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, mode='wb') as f:
+                np.savez(f, symbol=np.array(self.symbols, dtype=str), year=self.years, ingested_at=self.ingested_at,
+                         **self.fields)
+            os.replace(tmp_path, self.path)
+        self.changed = False
+        LOGGER.info("Saved the fundamentals of [%d] symbols over [%d] years.", len(self.symbols), len(self.years))
@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+import shutil
+from time import time_ns
+
+import numpy as np
+
+from service.cache_store import cache_key
+from stock_repository import FIELD_COLUMNS, StockRepository
+from utils import paths, utils
+from valuation.model import MODEL_VERSION
+
+HISTORY_DIR = 'history'  # in the data directory
+PART_PREFIX = 'part-'
+META_FILE = 'meta.json'
+LOGGER = logging.getLogger(__name__)
+
+
+class HistoryStore:
+    """
+    Append-only columnar store of the valuation inputs and outputs of every day.
+    Every day is a directory of parts, and every part a directory with one .npy file per column: 'symbol' and 'name'
+    as fixed-width strings, the numeric fields of a stock (FIELD_COLUMNS) and any extra column as float64,
+    NaN for missing values. Parts are written to a temporary directory and renamed into place, so readers,
+    from any process, only ever see complete parts. Columns are memory-mapped when read.
+    When a symbol is in several parts of a day, the last part wins.
+    """
+
+    def __init__(self, base_dir=None):
+        """
+        :param base_dir: directory of the store, HISTORY_DIR in the data directory if None.
+        """
+        self.base_dir = base_dir if base_dir is not None else paths.data_path(HISTORY_DIR)
+        os.makedirs(self.base_dir, exist_ok=True)
+
+    def append(self, day, symbols, names, columns):
+        """
+        Adds a part to a day.
+        :param day: date of the values.
+        :param symbols: stock symbols, one per row.
+        :param names: company names, in the order of `symbols`.
+        :param columns: dictionary of column name to values in the order of `symbols`.
+        :return: void
+        """
+        if not len(symbols):
+            return
+        day_dir = os.path.join(self.base_dir, str(day))
+        os.makedirs(day_dir, exist_ok=True)
+        part = f'{PART_PREFIX}{time_ns():020d}-{os.getpid()}'
+        tmp_dir = os.path.join(day_dir, f'.{part}.tmp')
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, 'symbol.npy'), np.array(symbols, dtype=str))
+        np.save(os.path.join(tmp_dir, 'name.npy'), np.array([name or '' for name in names], dtype=str))
+        for column, values in columns.items():
+            np.save(os.path.join(tmp_dir, f'{column}.npy'), np.asarray(values, dtype=np.float64))
+        with open(os.path.join(tmp_dir, META_FILE), mode='w', encoding='utf-8') as f:
+            json.dump({'rows': len(symbols), 'model_version': MODEL_VERSION}, f)
+        os.rename(tmp_dir, os.path.join(day_dir, part))
+
+    def append_stocks(self, day, stocks, extra_columns=None):
+        """
+        Adds the inputs and outputs of valued Stock objects to a day.
+        :param day: date of the valuation.
+        :param stocks: list of Stock objects.
+        :param extra_columns: dictionary of column name to values in the order of `stocks`, e.g. scenario results.
+        :return: void
+        """
+        repository = StockRepository.from_stocks(stocks)
+        self.append(day, repository.symbols, repository.names, dict(repository.columns, **(extra_columns or {})))
+
+    def dates(self):
+        """
+        :return: sorted list of the days in the store.
+        """
+        days = []
+        for entry in os.listdir(self.base_dir):
+            try:
+                days.append(utils.parse_date(entry))
+            except ValueError:
+                continue
+        return sorted(days)
+
+    def get_parts(self, day):
+        day_dir = os.path.join(self.base_dir, str(day))
+        if not os.path.isdir(day_dir):
+            return []
+        return [os.path.join(day_dir, entry) for entry in sorted(os.listdir(day_dir)) if entry.startswith(PART_PREFIX)]
+
+    def read(self, day, columns=None):
+        """
+        Reads a day, one row per symbol, sorted by symbol.
+        :param day: date to read.
+        :param columns: names of the columns to read besides 'symbol', every column if None.
+        :return: dictionary of column name to array. Empty if the day isn't in the store.
+        """
+        parts = []
+        for part_dir in self.get_parts(day):
+            names = columns if columns is not None else [entry[:-4] for entry in os.listdir(part_dir)
+                                                         if entry.endswith('.npy') and entry != 'symbol.npy']
+            part = {'symbol': np.load(os.path.join(part_dir, 'symbol.npy'), mmap_mode='r')}
+            for name in names:
+                path = os.path.join(part_dir, f'{name}.npy')
+                if os.path.isfile(path):
+                    part[name] = np.load(path, mmap_mode='r')
+                elif name == 'name':
+                    part[name] = np.full(len(part['symbol']), '')
+                else:
+                    part[name] = np.full(len(part['symbol']), np.nan)
+            parts.append(part)
+        if not parts:
+            return {}
+
+        names = set().union(*parts)
+        for part in parts:  # columns missing from older parts
+            for name in names - set(part):
+                part[name] = np.full(len(part['symbol']), '' if name == 'name' else np.nan)
+
+        if len(parts) == 1 and np.all(parts[0]['symbol'][:-1] < parts[0]['symbol'][1:]):
+            return parts[0]  # compacted day: the memory-mapped columns as they are
+        merged = {name: np.concatenate([part[name] for part in parts]) for name in names}
+        # last part wins: first occurrence of every symbol in the reversed rows
+        symbols, reversed_index = np.unique(merged['symbol'][::-1], return_index=True)
+        index = len(merged['symbol']) - 1 - reversed_index
+        return {name: values[index] for name, values in merged.items()}
+
+    def snapshot(self, day):
+        """
+        The whole universe on a day.
+        :return: a StockRepository, empty if the day isn't in the store.
+        """
+        columns = self.read(day, ['name'] + list(FIELD_COLUMNS))
+        return to_repository(columns)
+
+    def history(self, symbol, column='fair_price', start=None, end=None):
+        """
+        The values of a column for a symbol across days, e.g. its fair price history.
+        :param symbol: stock symbol.
+        :param column: column to read.
+        :param start: first day, the first day in the store if None.
+        :param end: last day, the last day in the store if None.
+        :return: tuple (list of days, float64 array of values), for the days the symbol was valued on.
+        """
+        symbol = cache_key(symbol)
+        days, values = [], []
+        for day in self.dates():
+            if (start is not None and day < start) or (end is not None and day > end):
+                continue
+            columns = self.read(day, [column])
+            if not columns:
+                continue
+            i = np.searchsorted(columns['symbol'], symbol)
+            if i < len(columns['symbol']) and columns['symbol'][i] == symbol:
+                days.append(day)
+                values.append(columns[column][i])
+        return days, np.array(values, dtype=np.float64)
+
+    def changes(self, start, end, column='fair_price'):
+        """
+        Compares a column between two days, for the symbols valued on both.
+        :param start: first day.
+        :param end: second day.
+        :param column: column to compare.
+        :return: dictionary with the 'symbol' array, the values on both days as 'before' and 'after',
+        and the relative 'change', sorted by symbol.
+        """
+        before = self.read(start, [column])
+        after = self.read(end, [column])
+        if not before or not after:
+            return {'symbol': np.array([], dtype=str), 'before': np.array([]), 'after': np.array([]),
+                    'change': np.array([])}
+        symbols, before_index, after_index = np.intersect1d(before['symbol'], after['symbol'], return_indices=True)
+        before_values = np.asarray(before[column][before_index])
+        after_values = np.asarray(after[column][after_index])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = after_values / before_values - 1
+        return {'symbol': symbols, 'before': before_values, 'after': after_values, 'change': change}
+
+    def compact(self, day):
+        """
+        Rewrites a day as a single part sorted by symbol, to be called when nothing else writes to that day.
+        :return: void
+        """
+        parts = self.get_parts(day)
+        if len(parts) <= 1:
+            return
+        columns = {name: np.array(values) for name, values in self.read(day).items()}
+        symbols = columns.pop('symbol')
+        names = columns.pop('name').tolist()
+        self.append(day, symbols.tolist(), names, columns)
+        for part_dir in parts:
+            shutil.rmtree(part_dir)
+        LOGGER.info("Compacted [%d] parts of %s into one.", len(parts), day)
+
+
+def to_repository(columns):
+    """
+    :param columns: columns returned by `HistoryStore.read`.
+    :return: a StockRepository of the rows.
+    """
+    if not columns:
+        return StockRepository()
+    return StockRepository(columns['symbol'].tolist(), [name or None for name in columns['name'].tolist()],
+                           {field: columns[field] for field in FIELD_COLUMNS})
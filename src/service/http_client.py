@@ -0,0 +1,144 @@
+import logging
+import random
+from time import sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.metrics import METRICS
+
+TIMEOUT = (5, 30)  # seconds to connect, seconds to wait for the response
+MAX_RETRIES = 4
+BACKOFF_BASE = 2.0  # seconds, doubled on every retry
+BACKOFF_MAX = 60.0  # seconds
+POOL_SIZE = 16  # connections kept alive, should cover the requests in flight in async mode
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+THROTTLE_KEYS = {'Note', 'Information'}
+THROTTLE_HINTS = ('call frequency', 'rate limit', 'requests per minute', 'api call volume')
+LOGGER = logging.getLogger(__name__)
+
+
+def is_throttle_response(data):
+    """
+    Recognizes the payloads Alpha Vantage returns with status 200 when a request is throttled, like
+    {"Note": "Thank you for using Alpha Vantage! Our standard API call frequency is ..."}.
+    :param data: decoded JSON body.
+    :return: True if the body is a throttle message.
+    """
+    if not isinstance(data, dict) or len(data) != 1 or not set(data) <= THROTTLE_KEYS:
+        return False
+    message = str(next(iter(data.values()))).lower()
+    return any(hint in message for hint in THROTTLE_HINTS)
+
+
+def is_error_response(data):
+    """
+    Recognizes the payloads Alpha Vantage returns with status 200 instead of data, like an invalid symbol
+    or an endpoint that isn't part of the plan.
+    :param data: decoded JSON body.
+    :return: True if the body is an error message.
+    """
+    return isinstance(data, dict) and len(data) == 1 and set(data) <= THROTTLE_KEYS | {'Error Message'}
+
+
+class ResponseError(Exception):
+    """
+    The API answered a request with an error instead of data: an error message or a status that isn't retried.
+    Unlike a request that failed for good, sending it again won't help.
+    """
+
+
+class HttpClient:
+    """
+    Connection-pooled HTTP client with timeouts. Connection errors, timeouts, transient status codes
+    and throttle messages are retried with exponential backoff and full jitter.
+    """
+
+    def __init__(self, timeout=TIMEOUT, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE,
+                 backoff_max=BACKOFF_MAX, pool_size=POOL_SIZE, rate_limiter=None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = rate_limiter  # every retry takes a token too
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_json(self, url, raise_errors=False):
+        """
+        Sends a GET request, retrying transient failures, and decodes its JSON body.
+        :param url: URL to request.
+        :param raise_errors: raise ResponseError when the API answers with an error, instead of returning None.
+        :return: the decoded JSON body, or None if the request failed for good or returned an error message.
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0 and self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            retry_after = None
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                kind = type(err).__name__
+                reason = f'{kind}: {err}'
+            else:
+                if response.status_code in RETRY_STATUS_CODES:
+                    kind = f'status_{response.status_code}'
+                    reason = f'status {response.status_code}'
+                    retry_after = response.headers.get('Retry-After')
+                elif response.status_code != 200:
+                    LOGGER.warning("Request failed with status %d: %s", response.status_code, self.redact(url))
+                    METRICS.count('failures_total', reason=f'status_{response.status_code}')
+                    if raise_errors:
+                        raise ResponseError(f'status {response.status_code}')
+                    return None
+                else:
+                    try:
+                        data = response.json()
+                    except ValueError as err:  # truncated or non-JSON body
+                        kind = 'invalid_json'
+                        reason = f'invalid JSON: {err}'
+                    else:
+                        if is_throttle_response(data):
+                            kind = 'throttled'
+                            reason = f'throttled: {next(iter(data.values()))}'
+                        elif is_error_response(data):
+                            LOGGER.warning("Request returned an error message: %s", data)
+                            METRICS.count('failures_total', reason='error_message')
+                            if raise_errors:
+                                raise ResponseError(next(iter(data.values())))
+                            return None
+                        else:
+                            return data
+
+            METRICS.count('http_failed_attempts_total', reason=kind)
+            if attempt == self.max_retries:
+                LOGGER.error("Giving up after %d attempts (%s): %s", attempt + 1, reason, self.redact(url))
+                METRICS.count('failures_total', reason='retries_exhausted')
+                return None
+
+            delay = self.get_backoff(attempt, retry_after)
+            LOGGER.warning("Attempt %d failed (%s). Retrying in %.1f seconds.", attempt + 1, reason, delay)
+            METRICS.observe('backoff_wait_seconds', delay)
+            sleep(delay)
+
+    def get_backoff(self, attempt, retry_after=None):
+        """
+        Seconds to wait before the next attempt: the server's Retry-After if it sent one,
+        otherwise a random delay up to `backoff_base * 2 ** attempt`, capped at `backoff_max`.
+        :param attempt: number of the failed attempt, starting at 0.
+        :param retry_after: value of the Retry-After header, if any.
+        :return: seconds to wait.
+        """
+        if retry_after is not None:
+            try:
+                return min(self.backoff_max, float(retry_after))
+            except ValueError:
+                pass  # an HTTP date, fall back to backoff
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def redact(url):
+        return url.split('&apikey=')[0]
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+from time import monotonic, sleep
+
+from utils.metrics import METRICS
+
+# Alpha Vantage's premium plan allows 75 requests per minute. A full bucket can send BURST requests at once,
+# so REQUESTS_PER_MINUTE + BURST is kept just under the quota.
+REQUESTS_PER_MINUTE = 68
+BURST = 5
+LOGGER = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared by every request of a run, from any thread or coroutine.
+    Tokens are added at `rate_per_minute` up to `burst`, and every request takes one.
+    """
+
+    def __init__(self, rate_per_minute=REQUESTS_PER_MINUTE, burst=BURST):
+        if rate_per_minute <= 0 or burst < 1:
+            raise ValueError(f"Invalid rate limit: {rate_per_minute} requests/minute with a burst of {burst}")
+        self.rate = rate_per_minute / 60  # tokens per second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token, going into debt if the bucket is empty so that callers are served in order.
+        :return: seconds the caller has to wait before sending its request.
+        """
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a request can be sent.
+        :return: seconds waited.
+        """
+        wait = self.reserve()
+        METRICS.observe('rate_limit_wait_seconds', wait)
+        if wait > 0:
+            LOGGER.debug("Rate limit reached. Waiting %.2f seconds.", wait)
+            sleep(wait)
+        return wait
+
+    async def acquire_async(self):
+        """
+        Waits, without blocking the event loop, until a request can be sent.
+        :return: seconds waited.
+        """
+        wait = self.reserve()
+        METRICS.observe('rate_limit_wait_seconds', wait)
+        if wait > 0:
+            LOGGER.debug("Rate limit reached. Waiting %.2f seconds.", wait)
+            await asyncio.sleep(wait)
+        return wait
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket whose state lives in shared memory, so that worker processes started with it as an argument
+    share one rate budget.
+    """
+
+    def __init__(self, rate_per_minute=REQUESTS_PER_MINUTE, burst=BURST):
+        if rate_per_minute <= 0 or burst < 1:
+            raise ValueError(f"Invalid rate limit: {rate_per_minute} requests/minute with a burst of {burst}")
+        self.rate = rate_per_minute / 60  # tokens per second
+        self.burst = burst
+        self.state = multiprocessing.Array('d', [float(burst), monotonic()])  # tokens, time of last update
+
+    def reserve(self):
+        with self.state.get_lock():
+            tokens, updated = self.state[:]
+            now = monotonic()
+            tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+            self.state[:] = [tokens, now]
+            return 0.0 if tokens >= 0 else -tokens / self.rate
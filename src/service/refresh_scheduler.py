@@ -0,0 +1,158 @@
+import logging
+import math
+from datetime import date, timedelta
+
+from service.cache_store import CACHE_USEFUL_LIFE
+from utils import utils
+from utils.api_function_enum import ApiFunction
+
+REQUESTS_PER_DAY = 5000  # default daily request budget of the refreshes
+STATEMENT_FUNCTIONS = (ApiFunction.CASH_FLOW, ApiFunction.BALANCE_SHEET, ApiFunction.EARNINGS)
+EARNINGS_INTERVAL = timedelta(days=91)  # companies report quarterly
+FILING_LAG = timedelta(days=7)  # time for new statements to show up in the API after the earnings date
+UPCOMING_EARNINGS = timedelta(days=14)  # statements fetched this close to the next earnings are about to be outdated
+MISSING_STALENESS = 2.0  # staleness of symbols that aren't cached, as a fraction of CACHE_USEFUL_LIFE
+NEW_EARNINGS_BOOST = 1.0  # priority added when statements were probably published since they were fetched
+UPCOMING_EARNINGS_PENALTY = 0.5  # priority removed from symbols that will report soon
+UNDERVALUED_RATIO = 1.0  # current/fair price ratio below which a stock is undervalued
+RELEVANCE_WIDTH = 0.3  # distance to UNDERVALUED_RATIO over which the relevance boost fades out
+RELEVANCE_BOOST = 0.5  # priority added to symbols right at UNDERVALUED_RATIO
+LOGGER = logging.getLogger(__name__)
+
+
+class RefreshScheduler:
+    """
+    Decides which symbols to refresh within a daily request budget, instead of refetching every symbol the day its
+    cached row expires. Symbols are ranked by:
+    - staleness: age of the cached row as a fraction of CACHE_USEFUL_LIFE, or MISSING_STALENESS if it isn't cached,
+    - earnings: statements are refetched once the next earnings, estimated from the cached EARNINGS response,
+      were published after they were fetched, and refreshes are deferred when earnings are about to come out,
+    - relevance: stocks whose current/fair ratio is close to UNDERVALUED_RATIO could change side with fresh data.
+    Due symbols (not cached or expired) are refreshed first, as far as the budget goes. Symbols that are not due yet
+    are refreshed early at the steady rate of the universe, which spreads the refreshes evenly over the days.
+    """
+
+    def __init__(self, cache_store, response_cache, daily_budget=REQUESTS_PER_DAY):
+        self.cache_store = cache_store
+        self.response_cache = response_cache
+        self.daily_budget = daily_budget
+
+    def plan(self, symbols, today=None):
+        """
+        Picks the symbols to refresh today.
+        :param symbols: symbols of the universe.
+        :param today: date of the plan, today if None.
+        :return: dictionary of symbol to the endpoints whose cached response must be discarded before fetching,
+        in priority order. The other endpoints are fetched if their cached response is stale.
+        """
+        today = today or date.today()
+        candidates = []
+        for symbol in symbols:
+            priority, due, discard = self.get_priority(symbol, today)
+            cost = self.get_cost(symbol, discard, today)
+            if due or cost:  # refreshing a symbol early from its cached responses wouldn't change anything
+                candidates.append((priority, due, cost, symbol, discard))
+        candidates.sort(key=lambda candidate: (candidate[1], candidate[0]), reverse=True)  # due ones first
+
+        # symbols that aren't due are spread over the days their rows stay fresh, due ones don't count
+        steady_rate = math.ceil(sum(candidate[2] for candidate in candidates if not candidate[1]) / CACHE_USEFUL_LIFE)
+        plan = {}
+        spent = early_spent = 0
+        for priority, due, cost, symbol, discard in candidates:
+            if spent + cost > self.daily_budget or (not due and early_spent + cost > steady_rate):
+                continue
+            plan[symbol] = discard
+            spent += cost
+            if not due:
+                early_spent += cost
+
+        due_count = sum(1 for candidate in candidates if candidate[1])
+        LOGGER.info("Refresh plan: [%d] symbols for %d requests out of a budget of %d. [%d] symbols are due, "
+                    "[%d] are left for the next days.", len(plan), spent, self.daily_budget, due_count,
+                    sum(1 for candidate in candidates if candidate[1] and candidate[3] not in plan))
+        return plan
+
+    def get_priority(self, symbol, today):
+        """
+        :return: tuple (priority, whether the symbol is due, endpoints to discard because their data is outdated).
+        """
+        row = self.cache_store.find(symbol)
+        if row is None:
+            staleness = MISSING_STALENESS
+        else:
+            fetched_on = utils.parse_date(row['expires_on']) - timedelta(days=CACHE_USEFUL_LIFE)
+            staleness = (today - fetched_on).days / CACHE_USEFUL_LIFE
+        due = staleness >= 1
+        priority = staleness
+        discard = []
+
+        next_earnings = self.get_next_earnings_date(symbol)
+        if next_earnings is not None:
+            statements_age = self.get_age(ApiFunction.CASH_FLOW, symbol, today)
+            statements_fetched_on = today - timedelta(seconds=statements_age or 0)
+            if statements_fetched_on < next_earnings + FILING_LAG <= today:
+                priority += NEW_EARNINGS_BOOST
+                discard = list(STATEMENT_FUNCTIONS)
+                due = True
+            elif timedelta(0) <= next_earnings - today <= UPCOMING_EARNINGS:
+                priority -= UPCOMING_EARNINGS_PENALTY
+
+        priority += RELEVANCE_BOOST * self.get_relevance(row)
+        return priority, due, discard
+
+    def get_next_earnings_date(self, symbol):
+        """
+        Estimates the date of the next earnings from the last reported date in the cached EARNINGS response.
+        :return: the estimated date, or None if there is no cached EARNINGS response with a reported date.
+        """
+        earnings = self.response_cache.read(ApiFunction.EARNINGS, symbol)
+        try:
+            return utils.parse_date(earnings['quarterlyEarnings'][0]['reportedDate']) + EARNINGS_INTERVAL
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def get_relevance(row):
+        """
+        :return: 1.0 for stocks right at UNDERVALUED_RATIO, down to 0.0 at RELEVANCE_WIDTH from it and for
+        stocks that aren't cached.
+        """
+        if row is None:
+            return 0.0
+        try:
+            ratio = float(row['current_price']) / float(row['fair_price'])
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            return 0.0
+        return max(0.0, 1 - abs(ratio - UNDERVALUED_RATIO) / RELEVANCE_WIDTH)
+
+    def get_age(self, func, symbol, today):
+        """
+        :return: age of a cached response in seconds on `today`, or None if it isn't cached.
+        """
+        age = self.response_cache.get_age(func, symbol)
+        if age is None:
+            return None
+        return age + (today - date.today()).total_seconds()
+
+    def get_cost(self, symbol, discard, today):
+        """
+        :return: number of requests refreshing the symbol takes: one per endpoint discarded or not freshly cached.
+        """
+        cost = 0
+        for func in ApiFunction:
+            age = self.get_age(func, symbol, today)
+            if func in discard or age is None or age > self.response_cache.ttl[func].total_seconds():
+                cost += 1
+        return cost
+
+    def prepare(self, plan):
+        """
+        Makes the next run refetch the planned symbols: their cached rows are dropped from the index and their
+        outdated responses are discarded.
+        :param plan: dictionary returned by `plan`.
+        :return: void
+        """
+        for symbol, discard in plan.items():
+            self.cache_store.evict(symbol)
+            for func in discard:
+                self.response_cache.discard(func, symbol)
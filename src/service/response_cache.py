@@ -0,0 +1,137 @@
+import gzip
+import json
+import logging
+import os
+from collections import Counter
+from datetime import timedelta
+from time import time
+
+from utils import paths
+from utils.api_function_enum import ApiFunction
+from utils.metrics import METRICS
+
+RESPONSE_CACHE_DIR = 'responses'  # in the data directory
+# how long the raw response of every endpoint stays fresh
+ENDPOINT_TTL = {
+    ApiFunction.CASH_FLOW: timedelta(days=91),  # statements only change quarterly
+    ApiFunction.BALANCE_SHEET: timedelta(days=91),
+    ApiFunction.EARNINGS: timedelta(days=91),
+    ApiFunction.OVERVIEW: timedelta(days=7),
+    ApiFunction.GLOBAL_QUOTE: timedelta(hours=12),  # refreshed by every daily run
+}
+ERROR_KEYS = {'Note', 'Information', 'Error Message'}  # keys of the payloads Alpha Vantage returns instead of data
+LOGGER = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Persistent cache of the raw JSON responses of the Alpha Vantage API, keyed by (ApiFunction, symbol).
+    Every response is stored as a gzip-compressed JSON file and is fresh for the TTL of its endpoint.
+    """
+
+    def __init__(self, cache_dir=None, ttl=None):
+        """
+        :param cache_dir: directory of the responses, RESPONSE_CACHE_DIR in the data directory if None.
+        :param ttl: dictionary of ApiFunction to timedelta, overriding ENDPOINT_TTL.
+        """
+        self.cache_dir = cache_dir if cache_dir is not None else paths.data_path(RESPONSE_CACHE_DIR)
+        self.ttl = dict(ENDPOINT_TTL, **(ttl or {}))
+        self.hits = Counter()
+        self.misses = Counter()
+        for func in ApiFunction:
+            os.makedirs(os.path.join(self.cache_dir, func.get_url_name()), exist_ok=True)
+
+    def get_path(self, func: ApiFunction, symbol: str):
+        return os.path.join(self.cache_dir, func.get_url_name(), f'{symbol.upper()}.json.gz')
+
+    def get(self, func: ApiFunction, symbol: str):
+        """
+        Looks up the cached response of an endpoint for a symbol.
+        :param func: endpoint function the response came from.
+        :param symbol: stock the response is for.
+        :return: the JSON object, or None if it isn't cached or is older than the TTL of the endpoint.
+        """
+        age = self.get_age(func, symbol)
+        if age is None or age > self.ttl[func].total_seconds():
+            self.misses[func] += 1
+            METRICS.count('response_cache_total', endpoint=func.get_url_name(),
+                          result='miss' if age is None else 'expired')
+            return None
+
+        data = self.read(func, symbol)
+        if data is None:
+            self.misses[func] += 1
+            METRICS.count('response_cache_total', endpoint=func.get_url_name(), result='unreadable')
+            return None
+
+        self.hits[func] += 1
+        METRICS.count('response_cache_total', endpoint=func.get_url_name(), result='hit')
+        return data
+
+    def get_age(self, func: ApiFunction, symbol: str):
+        """
+        :return: seconds since the response of an endpoint for a symbol was cached, or None if it isn't cached.
+        """
+        mtime = self.get_mtime(func, symbol)
+        return None if mtime is None else time() - mtime
+
+    def get_mtime(self, func: ApiFunction, symbol: str):
+        """
+        :return: time the response of an endpoint for a symbol was cached, or None if it isn't cached.
+        """
+        try:
+            return os.path.getmtime(self.get_path(func, symbol))
+        except OSError:
+            return None
+
+    def read(self, func: ApiFunction, symbol: str):
+        """
+        Reads a cached response whatever its age, e.g. to plan refreshes from the data it holds.
+        :return: the JSON object, or None if it isn't cached or can't be read.
+        """
+        path = self.get_path(func, symbol)
+        try:
+            with gzip.open(path, mode='rt', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:  # truncated or corrupted file
+            LOGGER.warning("Ignoring unreadable cached response %s: %s", path, err)
+            return None
+
+    def discard(self, func: ApiFunction, symbol: str):
+        """
+        Removes a cached response so that the next fetch sends a request.
+        :return: void
+        """
+        try:
+            os.remove(self.get_path(func, symbol))
+        except FileNotFoundError:
+            pass
+
+    def put(self, func: ApiFunction, symbol: str, data):
+        """
+        Stores the response of an endpoint for a symbol, unless it is one of Alpha Vantage's error payloads.
+        The file is written to a temporary path first so readers never see a partial file.
+        :param func: endpoint function the response came from.
+        :param symbol: stock the response is for.
+        :param data: JSON object returned by the endpoint.
+        :return: void
+        """
+        if not data or (isinstance(data, dict) and set(data) <= ERROR_KEYS):
+            return
+
+        path = self.get_path(func, symbol)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with gzip.open(tmp_path, mode='wt', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def log_stats(self):
+        """
+        Logs the hit and miss counts of every endpoint.
+        :return: void
+        """
+        for func in ApiFunction:
+            LOGGER.info("Response cache '%s': %d hits, %d misses", func.get_json_name(), self.hits[func], self.misses[func])
+        LOGGER.info("Response cache total: %d hits, %d misses", sum(self.hits.values()), sum(self.misses.values()))
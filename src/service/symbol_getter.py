@@ -1,8 +1,18 @@
-from pytickersymbols import PyTickerSymbols
-from utils import utils
+import json
+import logging
+import os
+import re
+from datetime import date
 
-PATH_TO_FILE = 'C:\\projects\\intrinsic-value-calc\\data\\symbols\\symbols.txt'
+from utils import paths, utils
+
+SYMBOLS_FILE = os.path.join('symbols', 'symbols.txt')  # in the data directory
+CHANGES_FILE = os.path.join('symbols', 'changes.jsonl')  # one line per update of the universe that changed it
+INDEX_DATA_FILE = os.path.join('symbols', 'index-data.json')  # tickers of every index, parsed once
 OTC_EXCHANGES = ['OTCMKTS', 'PINK', 'OTCBB', 'OTCQB']  # exchanges to exclude
+SHARE_CLASS_SEPARATORS = re.compile(r'[./ ]+')  # BRK.B, BRK/B and BRK B are BRK-B for Alpha Vantage
+VALID_SYMBOL = re.compile(r'[A-Z0-9][A-Z0-9-]*')
+LOGGER = logging.getLogger(__name__)
 
 
 def clean_ticker_list(ticker_list):
@@ -15,11 +25,149 @@ def clean_ticker_list(ticker_list):
         map(lambda x: x.split(':')[1], filter(lambda x: x.split(':')[0].upper() not in OTC_EXCHANGES, ticker_list)))
 
 
-if __name__ == '__main__':
+def normalize_symbol(symbol):
+    """
+    Normalizes a ticker to the form Alpha Vantage expects: upper case, with share classes after a dash.
+    :param symbol: ticker like ' brk.b'.
+    :return: the normalized symbol like 'BRK-B', or None if it isn't a valid symbol.
+    """
+    symbol = SHARE_CLASS_SEPARATORS.sub('-', symbol.strip().upper()).strip('-')
+    return symbol if VALID_SYMBOL.fullmatch(symbol) else None
+
+
+def normalize_symbols(symbols):
+    """
+    :param symbols: tickers, possibly duplicated or in different forms, like 'BRK.B' and 'brk-b'.
+    :return: list of the normalized symbols, once each, in the order they first appear. Invalid ones are dropped.
+    """
+    normalized = {}
+    for symbol in symbols:
+        normalized_symbol = normalize_symbol(symbol)
+        if normalized_symbol is None:
+            if symbol.strip():
+                LOGGER.warning("Ignoring invalid symbol '%s'.", symbol)
+            continue
+        normalized.setdefault(normalized_symbol, None)
+    return list(normalized)
+
+
+class Universe:
+    """
+    The persisted universe of symbols to value: the symbols file, deduplicated and normalized, and the history
+    of its changes. Every update is compared with the previous universe, and the symbols added and removed are
+    appended to the changes file, so that only added symbols need their fundamentals fetched.
+    """
+
+    def __init__(self, symbols_path=None, changes_path=None):
+        """
+        :param symbols_path: symbols file, SYMBOLS_FILE in the data directory if None.
+        :param changes_path: changes file, CHANGES_FILE in the data directory if None.
+        """
+        self.symbols_path = symbols_path if symbols_path is not None else paths.data_path(SYMBOLS_FILE)
+        self.changes_path = changes_path if changes_path is not None else paths.data_path(CHANGES_FILE)
+
+    def load(self):
+        """
+        :return: list of the symbols of the universe, normalized and once each, even if the file was edited by hand.
+        Empty if there is no symbols file.
+        """
+        return normalize_symbols(utils.text_to_list(self.symbols_path) or [])
+
+    def update(self, symbols, day=None):
+        """
+        Replaces the universe and records what changed.
+        :param symbols: tickers of the new universe, normalized and deduplicated here.
+        :param day: date of the change, today if None.
+        :return: dictionary with the sorted lists of 'added' and 'removed' symbols.
+        """
+        previous = self.load()
+        symbols = normalize_symbols(symbols)
+        added = sorted(set(symbols) - set(previous))
+        removed = sorted(set(previous) - set(symbols))
+
+        os.makedirs(os.path.dirname(self.symbols_path) or '.', exist_ok=True)
+        tmp_path = f'{self.symbols_path}.{os.getpid()}.tmp'
+        with open(tmp_path, mode='w', encoding='utf-8') as f:
+            f.writelines(f'{symbol}\n' for symbol in symbols)
+        os.replace(tmp_path, self.symbols_path)
+        if added or removed:
+            change = {'date': str(day or date.today()), 'added': added, 'removed': removed, 'size': len(symbols)}
+            with open(self.changes_path, mode='a', encoding='utf-8') as f:
+                f.write(json.dumps(change) + '\n')
+        LOGGER.info("Universe of [%d] symbols: [%d] added, [%d] removed.", len(symbols), len(added), len(removed))
+        return {'added': added, 'removed': removed}
+
+    def changes(self, since=None):
+        """
+        :param since: first date to return the changes of, every change if None.
+        :return: list of the recorded changes, oldest first, as dictionaries with 'date', 'added', 'removed'
+        and 'size'.
+        """
+        if not os.path.isfile(self.changes_path):
+            return []
+        with open(self.changes_path, mode='r', encoding='utf-8') as f:
+            changes = [json.loads(line) for line in f if line.strip()]
+        return [change for change in changes if since is None or utils.parse_date(change['date']) >= since]
+
+
+def get_index_data_version():
+    """
+    :return: the installed version of pytickersymbols, read from its metadata without importing it,
+    or None if it isn't installed.
+    """
+    from importlib import metadata
+
+    try:
+        return metadata.version('pytickersymbols')
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def load_index_tickers(refresh=False, path=None):
+    """
+    Loads the tickers of the S&P 500 and the Nasdaq 100. pytickersymbols parses its whole dataset when it is
+    used, so the tickers are cached in INDEX_DATA_FILE and only parsed again when the installed version of
+    pytickersymbols changes or when `refresh` is set.
+    :param refresh: parse the dataset even if the cached tickers are up to date.
+    :param path: index data file, INDEX_DATA_FILE in the data directory if None.
+    :return: dictionary of index name to its tickers, in the format ['NYSE:LIN', 'NYSE:MMM', ...]
+    """
+    path = path if path is not None else paths.data_path(INDEX_DATA_FILE, create_dir=True)
+    version = get_index_data_version()
+    cached = None
+    if os.path.isfile(path):
+        with open(path, mode='r', encoding='utf-8') as f:
+            cached = json.load(f)
+    if cached is not None and not refresh and (version is None or cached['version'] == version):
+        return cached['indices']
+    if version is None:
+        raise RuntimeError("Updating the symbols needs pytickersymbols. Install it with 'pip install pytickersymbols'.")
+
     # how to use this module https://github.com/portfolioplus/pytickersymbols
+    from pytickersymbols import PyTickerSymbols
+
     stock_data = PyTickerSymbols()
+    indices = {'sp500': list(stock_data.get_sp_500_nyc_google_tickers()),
+               'nasdaq100': list(stock_data.get_nasdaq_100_nyc_google_tickers())}
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, mode='w', encoding='utf-8') as f:
+        json.dump({'version': version, 'indices': indices}, f)
+    os.replace(tmp_path, path)
+    LOGGER.info("Parsed the tickers of %s with pytickersymbols %s.", ', '.join(indices), version)
+    return indices
+
 
-    sp500 = clean_ticker_list(stock_data.get_sp_500_nyc_google_tickers())
-    nasdaq100 = clean_ticker_list(stock_data.get_nasdaq_100_nyc_google_tickers())
+def update_symbols(universe=None, refresh=False):
+    """
+    Updates the universe with the symbols of the S&P 500 and the Nasdaq 100.
+    :param universe: Universe to update, the one in the data directory if None.
+    :param refresh: parse the index data again, see `load_index_tickers`.
+    :return: dictionary with the sorted lists of 'added' and 'removed' symbols.
+    """
+    universe = universe if universe is not None else Universe()
+    indices = load_index_tickers(refresh)
+    return universe.update(clean_ticker_list(indices['sp500']) + clean_ticker_list(indices['nasdaq100']))
 
-    utils.write_list_to_text_file(sp500 + nasdaq100, PATH_TO_FILE)
+
+if __name__ == '__main__':
+    update_symbols()
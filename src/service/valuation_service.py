@@ -0,0 +1,327 @@
+import json
+import logging
+import signal
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from service.data_service import MAX_IN_FLIGHT
+from service.symbol_getter import normalize_symbol, normalize_symbols
+from stock import Stock
+from utils.api_function_enum import ApiFunction
+from utils.metrics import METRICS
+
+VALUATION_TTL = 15 * 60  # seconds a valuation is served from memory
+FAILED_TTL = 5 * 60  # seconds a symbol that couldn't be valued isn't tried again
+MAX_ENTRIES = 10_000  # valuations kept in memory, the least recently used are evicted first
+REFRESH_AHEAD = 0.2  # hot entries are refreshed in the last fraction of their TTL
+REFRESH_INTERVAL = 10  # seconds between background refresh passes
+MAX_BATCH_SYMBOLS = 500  # symbols per batch lookup
+LOOKUP_WORKERS = max(1, MAX_IN_FLIGHT // len(ApiFunction))  # symbols fetched at once, every symbol holds 5 requests
+LOGGER = logging.getLogger(__name__)
+
+
+class Entry:
+    """
+    A valuation held in memory: the JSON body served for it, when it expires and how often it was read since
+    it was stored.
+    """
+    __slots__ = ('body', 'valued', 'expires_at', 'hits')
+
+    def __init__(self, body, valued, expires_at):
+        self.body = body
+        self.valued = valued
+        self.expires_at = expires_at
+        self.hits = 0
+
+
+class ValuationCache:
+    """
+    Size-bounded LRU cache of valuations with a TTL. Valuations are stored pre-serialized, so a hit is a
+    dictionary lookup and no JSON encoding. Symbols that couldn't be valued are cached too, for FAILED_TTL,
+    so that they aren't fetched again on every request.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=VALUATION_TTL, failed_ttl=FAILED_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.failed_ttl = failed_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, symbol):
+        """
+        :param symbol: normalized stock symbol.
+        :return: the Entry of the symbol, or None if it isn't cached or has expired.
+        """
+        with self.lock:
+            entry = self.entries.get(symbol)
+            if entry is None:
+                return None
+            if entry.expires_at <= monotonic():
+                del self.entries[symbol]
+                return None
+            self.entries.move_to_end(symbol)
+            entry.hits += 1
+            return entry
+
+    def put(self, symbol, stock):
+        """
+        Stores the valuation of a stock, evicting the least recently used entries over `max_entries`.
+        :param symbol: normalized stock symbol.
+        :param stock: valued Stock, or None if the symbol couldn't be valued.
+        :return: the new Entry.
+        """
+        valued = stock is not None and stock.fair_price is not None
+        body = json.dumps(stock.get_as_record() if valued else None, separators=(',', ':')).encode('utf-8')
+        entry = Entry(body, valued, monotonic() + (self.ttl if valued else self.failed_ttl))
+        with self.lock:
+            self.entries[symbol] = entry
+            self.entries.move_to_end(symbol)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                METRICS.count('service_evictions_total')
+        return entry
+
+    def get_due(self, ahead):
+        """
+        :param ahead: seconds before expiry from which an entry is due.
+        :return: symbols of the valued entries that expire within `ahead` seconds and were read since they were
+        stored. Entries nobody reads are left to expire.
+        """
+        due_at = monotonic() + ahead
+        with self.lock:
+            return [symbol for symbol, entry in self.entries.items()
+                    if entry.valued and entry.hits and entry.expires_at <= due_at]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ValuationService:
+    """
+    Values single symbols on demand for a long-running process, on top of the cache store and the data service
+    of a run. Valuations are kept in a ValuationCache. Concurrent lookups of a symbol that isn't cached share a
+    single fetch, and a background thread refreshes the entries that are read before they expire, with their
+    latest price from the bulk quotes endpoint.
+    """
+
+    def __init__(self, cache_store, data_service, cache=None, workers=LOOKUP_WORKERS,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.cache_store = cache_store
+        self.data_service = data_service
+        self.cache = cache if cache is not None else ValuationCache()
+        self.in_flight = {}  # symbol -> Future of the lookup fetching it
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lookup')
+        self.refresh_interval = refresh_interval
+        self.stopped = threading.Event()
+        self.refresher = threading.Thread(target=self.run_refresher, name='refresher', daemon=True)
+
+    def start(self):
+        self.refresher.start()
+
+    def stop(self):
+        """
+        Stops the background refresh and writes the pending cache rows.
+        :return: void
+        """
+        self.stopped.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.cache_store.close()
+
+    def lookup(self, symbol):
+        """
+        Looks up the valuation of a symbol, valuing it if it isn't cached.
+        :param symbol: stock symbol, normalized here.
+        :return: the Entry of the symbol.
+        """
+        normalized_symbol = normalize_symbol(symbol)
+        if normalized_symbol is None:
+            raise ValueError(f"Invalid symbol '{symbol}'")
+        symbol = normalized_symbol
+        entry = self.cache.get(symbol)
+        if entry is not None:
+            METRICS.count('service_lookups_total', result='hit')
+            return entry
+        return self.load(symbol).result()
+
+    def lookup_many(self, symbols):
+        """
+        Looks up the valuations of many symbols. The symbols that aren't cached are valued concurrently.
+        :param symbols: stock symbols, at most MAX_BATCH_SYMBOLS. Invalid ones are left out.
+        :return: dictionary of normalized symbol to its Entry, in the order of `symbols`.
+        """
+        symbols = normalize_symbols(symbols)
+        if len(symbols) > MAX_BATCH_SYMBOLS:
+            raise ValueError(f"At most {MAX_BATCH_SYMBOLS} symbols can be looked up at once, got {len(symbols)}")
+        entries = {symbol: self.cache.get(symbol) for symbol in symbols}
+        METRICS.count('service_lookups_total', sum(entry is not None for entry in entries.values()), result='hit')
+        futures = {symbol: self.executor.submit(self.lookup, symbol)
+                   for symbol, entry in entries.items() if entry is None}
+        for symbol, future in futures.items():
+            entries[symbol] = future.result()
+        return entries
+
+    def load(self, symbol, current_price=None):
+        """
+        Values a symbol and caches its valuation. A lookup of a symbol that is already being loaded waits for
+        that load instead of fetching the symbol again.
+        :param symbol: normalized stock symbol.
+        :param current_price: latest price of the stock, to reprice it with.
+        :return: Future of the Entry of the symbol.
+        """
+        with self.lock:
+            future = self.in_flight.get(symbol)
+            if future is not None:
+                METRICS.count('service_lookups_total', result='coalesced')
+                return future
+            future = self.in_flight[symbol] = Future()
+        METRICS.count('service_lookups_total', result='miss')
+
+        try:
+            with METRICS.timer('stage_seconds', stage='service_load'):
+                stock = Stock(symbol, cache_store=self.cache_store, data_service=self.data_service)
+                if current_price is not None and stock.fair_price is not None:
+                    stock.reprice(current_price)
+            future.set_result(self.cache.put(symbol, stock))
+        except BaseException as err:
+            LOGGER.error("[%s] Lookup failed: %s", symbol, err)
+            future.set_exception(err)
+        finally:
+            with self.lock:
+                del self.in_flight[symbol]
+        return future
+
+    def refresh(self):
+        """
+        Values the due entries of the cache again, repricing them with one bulk quotes request per
+        BULK_QUOTES_MAX_SYMBOLS symbols. Their fundamentals come from the cache store unless they expired there too.
+        :return: number of entries refreshed.
+        """
+        symbols = self.cache.get_due(self.cache.ttl * REFRESH_AHEAD)
+        if not symbols:
+            return 0
+        with METRICS.timer('stage_seconds', stage='service_refresh'):
+            quotes = self.data_service.fetch_quotes(symbols)
+            futures = [self.executor.submit(self.load, symbol, quotes.get(symbol)) for symbol in symbols]
+            for future in futures:
+                future.result()
+        LOGGER.info("Refreshed [%d] valuations.", len(symbols))
+        return len(symbols)
+
+    def run_refresher(self):
+        while not self.stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as err:  # keep refreshing, the next pass may succeed
+                LOGGER.error("Background refresh failed: %s", err)
+            self.cache_store.flush_if_due()  # lookups may have buffered rows and then gone idle
+
+
+class ValuationHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of a ValuationService:
+    - GET /value/<symbol>: the result record of a symbol, 404 if it can't be valued,
+    - GET /values?symbols=A,B,C or POST /values with {"symbols": [...]}: {"values": {symbol: record or null}},
+    - GET /health: {"status": "ok", "entries": <valuations in memory>},
+    - GET /metrics: counters and latencies in the Prometheus text format.
+    Records are keyed by rendering.RESULT_COLUMNS and hold raw numbers.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive, every response has a Content-Length
+    disable_nagle_algorithm = True
+    server_version = 'IntrinsicValue'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        service = self.server.service
+        if url.path.startswith('/value/'):
+            symbol = unquote(url.path[len('/value/'):]).strip()
+            if not symbol:
+                self.send_json(400, {'error': 'missing symbol'})
+                return
+            try:
+                entry = service.lookup(symbol)
+            except ValueError as err:
+                self.send_json(400, {'error': str(err)})
+                return
+            if not entry.valued:
+                self.send_json(404, {'error': 'symbol could not be valued'})
+            else:
+                self.send_body(200, entry.body)
+        elif url.path == '/values':
+            symbols = ','.join(parse_qs(url.query).get('symbols', [])).split(',')
+            self.send_values(symbols)
+        elif url.path == '/health':
+            self.send_json(200, {'status': 'ok', 'entries': len(service.cache)})
+        elif url.path == '/metrics':
+            self.send_body(200, METRICS.to_prometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+        else:
+            self.send_json(404, {'error': f'unknown path {url.path}'})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != '/values':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            symbols = request['symbols']
+            if not isinstance(symbols, list) or not all(isinstance(symbol, str) for symbol in symbols):
+                raise TypeError('symbols must be a list of strings')
+        except (ValueError, KeyError, TypeError) as err:
+            self.send_json(400, {'error': f'invalid request: {err}'})
+            return
+        self.send_values(symbols)
+
+    def send_values(self, symbols):
+        try:
+            entries = self.server.service.lookup_many(symbols)
+        except ValueError as err:
+            self.send_json(400, {'error': str(err)})
+            return
+        # the cached bodies are spliced in as they are
+        body = b','.join(json.dumps(symbol).encode('utf-8') + b':' + entry.body for symbol, entry in entries.items())
+        self.send_body(200, b'{"values":{' + body + b'}}')
+
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data).encode('utf-8'))
+
+    def send_body(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug("%s - %s", self.address_string(), format % args)
+
+
+def serve(service, host, port):
+    """
+    Serves the valuations of `service` over HTTP until interrupted or terminated. Must run in the main thread.
+    :param service: a ValuationService.
+    :param host: address to listen on.
+    :param port: port to listen on.
+    :return: void
+    """
+    server = ThreadingHTTPServer((host, port), ValuationHandler)
+    server.daemon_threads = True
+    server.service = service
+    signal.signal(signal.SIGTERM, stop_serving)
+    service.start()
+    LOGGER.info("Serving valuations on http://%s:%d", host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        LOGGER.info("Stopping...")
+    finally:
+        server.server_close()
+        service.stop()
+
+
+def stop_serving(signum, frame):
+    raise KeyboardInterrupt  # stops `serve` the same way as Ctrl+C
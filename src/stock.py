@@ -1,24 +1,31 @@
-import csv
 import logging
-import os
+import math
 import traceback
 
 from utils import utils
-from datetime import date
-from service.data_service import DataService
+from utils.metrics import METRICS
+from valuation.model import STAGE_YEARS, GROWTH_FADE, MODEL_VERSION, EPS_GROWTH_SHARE
 
-BASE_DIR = 'C:\\projects\\intrinsic-value-calc'
-CACHE_FILE = f'{BASE_DIR}\\data\\cache.csv'
-LAST_CACHE_DT_FILE = f'{BASE_DIR}\\data\\date_of_last_cache.txt'
-CACHE_USEFUL_LIFE = 30  # days
 LOGGER = logging.getLogger(__name__)
 
 
 class Stock:
     """
     A class representing a stock and its financial data.
+    Without a cache store or a data service, a Stock is a plain record and building it doesn't do any I/O.
+    Slots keep large numbers of instances small, see also StockRepository for whole universes.
     """
-    def __init__(self, symbol, eps_next_5y=None):
+    __slots__ = ('symbol', 'name', 'free_cash_flow', 'cash', 'total_debt', 'outstanding_shares', 'beta',
+                 'eps_next_5y', 'current_price', 'price_to_book', 'fair_price', 'present_value', 'cache_store')
+
+    def __init__(self, symbol, eps_next_5y=None, cache_store=None, data_service=None):
+        """
+        :param symbol: stock symbol.
+        :param eps_next_5y: expected EPS growth for the next 5 years, e.g. from the batch estimates of a run,
+        estimated from earnings if None.
+        :param cache_store: CacheStore to load the stock from and save it to.
+        :param data_service: DataService to fetch the stock with if it isn't cached.
+        """
         self.symbol = symbol.upper()
         self.name = None
         self.free_cash_flow = None
@@ -32,17 +39,31 @@ class Stock:
         self.fair_price = None
         self.present_value = None
 
-        self.get_data(DataService())
+        self.cache_store = cache_store
+        if cache_store is not None or data_service is not None:
+            self.get_data(data_service)
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Builds a stock from a cache row, without any I/O.
+        :param row: dictionary keyed by CACHE_HEADERS.
+        :return: a Stock.
+        """
+        stock = cls(row['symbol'])
+        stock.set_from_row(row)
+        return stock
 
     def get_data(self, data_service=None):
         """
         Fetches data for the stock from the API or from a CSV file.
-        :param data_service: A DataService object to fetch data from the API.
+        :param data_service: A DataService object to fetch data from the API. Only the cache is read if None.
         :return: void
         """
-        if not self.get_data_from_csv():
+        if not self.get_data_from_csv() and data_service is not None:
             try:
-                response = data_service.fetch_all_data(self.symbol)
+                with METRICS.timer('stage_seconds', stage='fetch'):
+                    response = data_service.fetch_all_data(self.symbol)
                 if response is None:
                     LOGGER.warning("[%s] Failed to fetch data from API.", self.symbol)
                     return
@@ -66,24 +87,33 @@ class Stock:
                 self.outstanding_shares = utils.safe_float(overview['SharesOutstanding'])
 
                 self.current_price = utils.safe_float(global_quote['05. price'])
-                self.calculate_eps_next_5y(earnings)
+                if self.eps_next_5y is None:
+                    self.calculate_eps_next_5y(earnings)
             except ValueError:
                 LOGGER.error("ValueError: Could not convert data to float for [%s]. %s", self.symbol,
                              traceback.format_exc())
+                METRICS.count('failures_total', reason='ValueError')
                 return
             except KeyError as err:
                 LOGGER.error("KeyError: missing key data point for [%s]. Cancelling... %s", self.symbol, traceback.format_exc())
+                METRICS.count('failures_total', reason='KeyError')
                 return
             except BaseException as err:
                 LOGGER.error("[%s] Unexpected %s, %s. Traceback: %s", self.symbol, err, type(err),
                              traceback.format_exc())
+                METRICS.count('failures_total', reason=type(err).__name__)
                 return
 
-            self.compute_valuation()
+            with METRICS.timer('stage_seconds', stage='valuation'):
+                self.compute_valuation()
+            if self.fair_price is not None:
+                self.save_data_to_csv()
 
     def calculate_eps_next_5y(self, earnings):
         """
-        Calculates the expected EPS growth for the next 5 years using data from the previous `len(earnings)` years.
+        Calculates the expected EPS growth for the next 5 years using data from the previous `len(earnings)` years:
+        the past EPS growth by the estimator of the model (see valuation.growth), or the growth between the latest and
+        the oldest EPS when it has none, e.g. after a loss.
         :param earnings: The earnings data fetched from the API.
         :return: void
         """
@@ -91,120 +121,147 @@ class Stock:
         if periods < 1 or earnings[0]['reportedEPS'] is None:
             self.eps_next_5y = 0.0
         else:
-            latest_eps = utils.safe_float(earnings[0]['reportedEPS'])
-            oldest_eps = utils.safe_float(earnings[-1]['reportedEPS'])
-            eps_agr = utils.calculate_annual_growth_rate(latest_eps, oldest_eps, periods)
+            from valuation import growth
+            from valuation.revalue import to_float
+
+            annual_eps = {}
+            for report in earnings:
+                try:
+                    year = int(report['fiscalDateEnding'][:4])
+                except (KeyError, TypeError, ValueError):  # no fiscal year to place the period at
+                    continue
+                annual_eps.setdefault(year, to_float(report.get('reportedEPS')))  # most recent report first
+            eps_agr = math.nan
+            if annual_eps:
+                years = range(min(annual_eps), max(annual_eps) + 1)
+                eps_agr = float(growth.eps_growth(growth.pad([annual_eps], years))[0])
+            if math.isnan(eps_agr):
+                latest_eps = utils.safe_float(earnings[0]['reportedEPS'])
+                oldest_eps = utils.safe_float(earnings[-1]['reportedEPS'])
+                eps_agr = utils.calculate_annual_growth_rate(latest_eps, oldest_eps, periods)
 
             if eps_agr is None:
                 self.eps_next_5y = None
                 LOGGER.info("[%s] Calculated EPS AGR over the last %d periods: %s", self.symbol, periods, eps_agr)
             else:
-                self.eps_next_5y = eps_agr / 2 # using half of AGR to get a conservative EPS estimate for the next 5 years
+                self.eps_next_5y = eps_agr * EPS_GROWTH_SHARE
                 LOGGER.info("[%s] Calculated EPS AGR over the last %d periods: %.2f", self.symbol, periods, eps_agr*100)
 
     def compute_valuation(self):
         """
-        Computes the valuation of the stock using the Discounted Cash Flow (DCF) method.
+        Computes the valuation of the stock using the Discounted Cash Flow (DCF) method,
+        with the parameters in valuation.model.
         :return: void
         """
         discounted_cashflow = 0
         if self.eps_next_5y is not  None:
-            eps_6_to_10y = self.eps_next_5y / 2
-            eps_10to_20y = eps_6_to_10y / 2
+            growth = self.eps_next_5y
             wacc = float(utils.find_wacc(self.beta))
 
             discount_factor = 1 / (1 + wacc)
-            free_cashflow_today = self.free_cash_flow
-
-            for i in range(1, 6):
-                discounted_cashflow += free_cashflow_today * (1 + self.eps_next_5y) ** i * discount_factor ** i
+            free_cashflow = self.free_cash_flow  # free cash flow at the start of the stage
+            years_before_stage = 0
 
-            free_cashflow_year_5 = free_cashflow_today * (1 + self.eps_next_5y) ** 5
-            for i in range(1, 6):
-                discounted_cashflow += free_cashflow_year_5 * (1 + eps_6_to_10y) ** i * discount_factor ** (i + 5)
+            for stage_years in STAGE_YEARS:
+                for i in range(1, stage_years + 1):
+                    discounted_cashflow += free_cashflow * (1 + growth) ** i * discount_factor ** (i + years_before_stage)
 
-            free_cashflow_year_10 = free_cashflow_year_5 * (1 + eps_6_to_10y) ** 5
-            for i in range(1, 11):
-                discounted_cashflow += free_cashflow_year_10 * (1 + eps_10to_20y) ** i * discount_factor ** (i + 10)
+                free_cashflow = free_cashflow * (1 + growth) ** stage_years
+                years_before_stage += stage_years
+                growth = growth * GROWTH_FADE
 
             self.present_value = self.cash - self.total_debt + discounted_cashflow
             self.fair_price = self.present_value / self.outstanding_shares
 
-            self.save_data_to_csv()
-
     def get_data_from_csv(self):
         """
-        Retrieves data from the cache CSV file. If the cache is older than 30 days,
-        doesn't exist, or is empty, it creates a new cache file with headers only.
-        :return: True if data was found in the cache, False otherwise.
-        """
-        with open(LAST_CACHE_DT_FILE, mode='r', newline='', encoding='utf-8') as f:
-            latest_cache = f.read()
-            latest_cache = utils.parse_date(latest_cache)
-
-        cache_is_too_old = (date.today() - latest_cache).days > CACHE_USEFUL_LIFE
-        if cache_is_too_old or (not os.path.isfile(CACHE_FILE)) or (os.path.getsize(CACHE_FILE) == 0):
-            with open(CACHE_FILE, mode='w', newline='') as f:
-                headers = ['symbol', 'name', 'fcc', 'cash', 'total_debt',
-                           'shares', 'beta', 'eps_next_5y', 'current_price',
-                           'fair_price', 'price_to_book', 'PV']
-                writer = csv.writer(f)
-                writer.writerow(headers)
-            LOGGER.info("Cache file was over 30 days old, didn't exist or was empty. It was set to have headers only.")
+        Retrieves data from the cache store, which expires every symbol on its own. Rows valued with another
+        version of the model are valued again from their cached inputs, or the EPS growth given to the stock,
+        without fetching anything.
+        :return: True if fresh data was found in the cache, False otherwise.
+        """
+        if self.cache_store is None:
+            return False
+        row = self.cache_store.get(self.symbol)
+        if row is None:
             return False
 
-        with open(CACHE_FILE, mode='r') as csv_file:
-            csv_reader = csv.DictReader(csv_file)
-            for row in csv_reader:
-                if row['symbol'].upper() == self.symbol:
-                    self.name = row['name']
-                    self.free_cash_flow = float(row['fcc'])
-                    self.cash = float(row['cash'])
-                    self.total_debt = float(row['total_debt'])
-                    self.outstanding_shares = float(row['shares'])
-                    self.beta = float(row['beta'])
-                    self.current_price = float(row['current_price'])
-                    self.fair_price = float(row['fair_price'])
-                    self.price_to_book = float(row['price_to_book'])
-                    self.present_value = float(row['PV'])
-
-                    LOGGER.info('Retrieved [%s] from cache.csv.', self.symbol)
-                    return True
-
-        return False
+        eps_next_5y = self.eps_next_5y  # estimate given to the stock, if any
+        self.set_from_row(row)
+        LOGGER.info('Retrieved [%s] from cache.csv.', self.symbol)
+        if row.get('model_version') != MODEL_VERSION:
+            if eps_next_5y is not None:
+                self.eps_next_5y = eps_next_5y
+            if self.eps_next_5y is not None:
+                self.compute_valuation()
+                self.cache_store.update(self.symbol, {'eps_next_5y': self.eps_next_5y, 'fair_price': self.fair_price,
+                                                      'PV': self.present_value, 'model_version': MODEL_VERSION})
+            LOGGER.info('Revalued [%s] with model version %s.', self.symbol, MODEL_VERSION)
+        return True
+
+    def set_from_row(self, row):
+        """
+        Sets the data of the stock from a cache row.
+        :param row: dictionary keyed by CACHE_HEADERS.
+        :return: void
+        """
+        self.name = row['name']
+        self.free_cash_flow = float(row['fcc'])
+        self.cash = float(row['cash'])
+        self.total_debt = float(row['total_debt'])
+        self.outstanding_shares = float(row['shares'])
+        self.beta = float(row['beta'])
+        self.current_price = float(row['current_price'])
+        self.fair_price = float(row['fair_price'])
+        self.price_to_book = float(row['price_to_book'])
+        self.present_value = float(row['PV'])
+        if row['eps_next_5y'] not in ('', 'None', None):
+            self.eps_next_5y = float(row['eps_next_5y'])
 
     def save_data_to_csv(self):
         """
-        Saves the stock data to the cache CSV file.
+        Saves the stock data to the cache store, if it has one.
         :return: void
         """
-        fields = [self.symbol, self.name, self.free_cash_flow, self.cash, self.total_debt,
-                  self.outstanding_shares, self.beta, self.eps_next_5y, self.current_price,
-                  self.fair_price, self.price_to_book, self.present_value]
+        if self.cache_store is None:
+            return
+        self.cache_store.put({'symbol': self.symbol, 'name': self.name, 'fcc': self.free_cash_flow,
+                              'cash': self.cash, 'total_debt': self.total_debt,
+                              'shares': self.outstanding_shares, 'beta': self.beta,
+                              'eps_next_5y': self.eps_next_5y, 'current_price': self.current_price,
+                              'fair_price': self.fair_price, 'price_to_book': self.price_to_book,
+                              'PV': self.present_value, 'model_version': MODEL_VERSION})
 
-        with open(CACHE_FILE, mode='a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(fields)
+    def reprice(self, current_price):
+        """
+        Updates the current price of the stock, in memory and in the cache, without touching the DCF inputs.
+        Market cap and the current/fair ratio are derived from it in `get_as_record`.
+        :param current_price: latest price of the stock.
+        :return: void
+        """
+        self.current_price = current_price
+        if self.cache_store is not None and self.symbol in self.cache_store:
+            self.cache_store.update(self.symbol, {'current_price': current_price})
 
-        with open(LAST_CACHE_DT_FILE, mode='w', newline='', encoding='utf-8') as f:
-            f.write(str(date.today()))
-            LOGGER.info('Updated date of last cache.')
+    def get_as_record(self):
+        """
+        Returns the results of the stock as raw numbers.
+        :return: dictionary keyed by rendering.RESULT_COLUMNS, None for missing values.
+        """
+        market_cap = current_to_fair = None
+        if self.current_price is not None and self.outstanding_shares is not None:
+            market_cap = self.current_price * self.outstanding_shares
+        if self.current_price is not None and self.fair_price:
+            current_to_fair = self.current_price / self.fair_price
+        return {'symbol': self.symbol, 'name': self.name, 'market_cap': market_cap,
+                'present_value': self.present_value, 'current_price': self.current_price,
+                'fair_price': self.fair_price, 'price_to_book': self.price_to_book, 'current_to_fair': current_to_fair}
 
     def get_as_row(self):
         """
         Returns a list representing the stock data in a row format for display.
         :return: An instance of Stock as a list.
         """
-        try:
-            row = [self.symbol,
-                   self.name,
-                   utils.format_currency(float(self.current_price * self.outstanding_shares)),
-                   utils.format_currency(float(self.present_value)),
-                   utils.format_currency(float(self.current_price)),
-                   utils.format_currency(float(self.fair_price)),
-                   '{:,.2f}'.format(float(self.price_to_book)),
-                   '{:,.0f}%'.format(float(self.current_price / self.fair_price * 100))]
-        except TypeError as err:
-            row = [self.symbol, self.name, 'n/a', 'n/a', 'n/a', 'n/a', 'n/a', 'n/a']
-            LOGGER.warning('[%s] TypeError when getting table row. Err: %s', self.symbol, err)
-        return row
+        import rendering  # imports numpy, which reading the cache doesn't need
+
+        return rendering.format_record(self.get_as_record())
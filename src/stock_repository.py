@@ -0,0 +1,166 @@
+import logging
+import sys
+
+import numpy as np
+
+from service.cache_store import cache_key
+from stock import Stock
+from valuation import dcf
+from valuation.revalue import to_float
+
+# Stock attribute -> cache column, for every numeric field of a stock
+FIELD_COLUMNS = {'free_cash_flow': 'fcc', 'cash': 'cash', 'total_debt': 'total_debt',
+                 'outstanding_shares': 'shares', 'beta': 'beta', 'eps_next_5y': 'eps_next_5y',
+                 'current_price': 'current_price', 'fair_price': 'fair_price', 'price_to_book': 'price_to_book',
+                 'present_value': 'PV'}
+LOGGER = logging.getLogger(__name__)
+
+
+class StockRepository:
+    """
+    Array-backed records of a whole universe of stocks: one float64 array per numeric field, missing values as NaN,
+    and symbols and names in lists. 50k stocks take about 12 MB and are built from arrays in milliseconds:
+    the symbol index is only built by the first lookup, and Stock objects are only materialized, as copies,
+    for the symbols asked for with `get`.
+    """
+
+    def __init__(self, symbols=(), names=None, columns=None):
+        """
+        :param symbols: upper-case stock symbols, one per record.
+        :param names: company names, in the order of `symbols`.
+        :param columns: dictionary of field of FIELD_COLUMNS to an array in the order of `symbols`.
+        Missing fields are all NaN.
+        """
+        self.symbols = list(symbols)
+        self.index = None  # symbol -> position, built on first lookup
+        self.names = list(names) if names is not None else [None] * len(self.symbols)
+        columns = columns or {}
+        self.columns = {field: np.asarray(columns[field], dtype=np.float64) if field in columns
+                        else np.full(len(self.symbols), np.nan) for field in FIELD_COLUMNS}
+        self.buffers = self.columns  # arrays the columns are views of, with room for the records added by `put`
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds the records of many cache rows in bulk.
+        :param rows: iterable of dictionaries keyed by CACHE_HEADERS.
+        :return: a StockRepository.
+        """
+        rows = list(rows)
+        columns = {field: np.array([to_float(row.get(column)) for row in rows])
+                   for field, column in FIELD_COLUMNS.items()}
+        return cls([cache_key(row['symbol']) for row in rows], [row['name'] for row in rows], columns)
+
+    @classmethod
+    def from_cache_store(cls, cache_store):
+        """
+        Builds the records of every fresh row of a cache store, without any network call.
+        :return: a StockRepository.
+        """
+        return cls.from_rows(cache_store.snapshot())
+
+    @classmethod
+    def from_stocks(cls, stocks):
+        stocks = list(stocks)
+        columns = {field: np.array([to_float(getattr(stock, field)) for stock in stocks]) for field in FIELD_COLUMNS}
+        return cls([stock.symbol for stock in stocks], [stock.name for stock in stocks], columns)
+
+    def find(self, symbol):
+        """
+        :return: position of the record of a symbol, or None if the symbol isn't in the repository.
+        """
+        if self.index is None:
+            self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        return self.index.get(cache_key(symbol))
+
+    def get(self, symbol):
+        """
+        Materializes the record of a symbol as a Stock, without any I/O. Changes to the Stock aren't written back,
+        see `put`.
+        :param symbol: stock symbol.
+        :return: a Stock, or None if the symbol isn't in the repository.
+        """
+        i = self.find(symbol)
+        if i is None:
+            return None
+        stock = Stock(self.symbols[i])
+        stock.name = self.names[i]
+        for field, column in self.columns.items():
+            value = column[i]
+            setattr(stock, field, None if np.isnan(value) else float(value))
+        return stock
+
+    def put(self, stock):
+        """
+        Adds or replaces the record of a stock.
+        :param stock: a Stock.
+        :return: void
+        """
+        i = self.find(stock.symbol)
+        if i is None:
+            i = self.index[stock.symbol] = len(self.symbols)
+            self.symbols.append(stock.symbol)
+            self.names.append(stock.name)
+            self.grow(len(self.symbols))
+        self.names[i] = stock.name
+        for field, column in self.columns.items():
+            column[i] = to_float(getattr(stock, field))
+
+    def grow(self, size):
+        """
+        Resizes the columns to `size` records. The buffers double when they are full, so that adding records one
+        at a time doesn't copy every column each time.
+        :param size: new number of records.
+        :return: void
+        """
+        capacity = len(next(iter(self.buffers.values())))
+        if size > capacity:
+            buffers = {}
+            for field, column in self.columns.items():
+                buffers[field] = np.full(max(size, 2 * capacity), np.nan)
+                buffers[field][:len(column)] = column
+            self.buffers = buffers
+        self.columns = {field: buffer[:size] for field, buffer in self.buffers.items()}
+
+    def compute_valuations(self):
+        """
+        Values every record with a growth estimate in one batch, see valuation.dcf.
+        :return: void
+        """
+        c = self.columns
+        present_values, fair_prices = dcf.compute_fair_prices(c['free_cash_flow'], c['cash'], c['total_debt'],
+                                                              c['outstanding_shares'], c['beta'], c['eps_next_5y'])
+        valued = ~np.isnan(fair_prices)
+        c['present_value'][valued] = present_values[valued]
+        c['fair_price'][valued] = fair_prices[valued]
+
+    def save(self, path):
+        """
+        Writes every record to a .npz file, which `load` reads back without parsing any text.
+        :return: void
+        """
+        np.savez(path, symbols=np.array(self.symbols, dtype=str),
+                 names=np.array([name or '' for name in self.names], dtype=str), **self.columns)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['symbols'].tolist(), [name or None for name in data['names'].tolist()],
+                       {field: data[field] for field in FIELD_COLUMNS})
+
+    @property
+    def nbytes(self):
+        """
+        :return: approximate memory used by the records, in bytes.
+        """
+        return (sum(column.nbytes for column in self.columns.values()) + sys.getsizeof(self.index or {})
+                + sum(map(sys.getsizeof, self.symbols)) + sum(map(sys.getsizeof, self.names)))
+
+    def __contains__(self, symbol):
+        return self.find(symbol) is not None
+
+    def __iter__(self):
+        return (self.get(symbol) for symbol in self.symbols)
+
+    def __len__(self):
+        return len(self.symbols)
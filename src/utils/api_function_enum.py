@@ -2,8 +2,29 @@ from enum import Enum
 import os
 
 
-API_KEY = os.environ['ALPHA_VANTAGE_PREM_API_KEY']
-BASE_URL = 'https://www.alphavantage.co/query?function={}&symbol={}&apikey=' + API_KEY
+API_KEY_ENV = 'ALPHA_VANTAGE_PREM_API_KEY'
+API_URL_ENV = 'ALPHA_VANTAGE_API_URL'  # overridable to point at a stub server
+DEFAULT_API_URL = 'https://www.alphavantage.co/query'
+# premium endpoint returning the latest quote of up to BULK_QUOTES_MAX_SYMBOLS comma-separated symbols per request
+BULK_QUOTES_FUNCTION = 'REALTIME_BULK_QUOTES'
+BULK_QUOTES_MAX_SYMBOLS = 100
+
+
+def get_base_url():
+    """
+    Builds the URL template of the API from the environment, when a request is about to be sent, so that
+    importing this module doesn't require an API key.
+    :return: URL with placeholders for the function and the symbol.
+    """
+    try:
+        api_key = os.environ[API_KEY_ENV]
+    except KeyError:
+        raise RuntimeError(f"Environment variable {API_KEY_ENV} must be set to request the Alpha Vantage API.") from None
+    return os.environ.get(API_URL_ENV, DEFAULT_API_URL) + '?function={}&symbol={}&apikey=' + api_key
+
+
+def get_bulk_quotes_url():
+    return get_base_url().format(BULK_QUOTES_FUNCTION, '{}')
 
 
 class ApiFunction(Enum):
@@ -14,7 +35,7 @@ class ApiFunction(Enum):
     EARNINGS = ('EARNINGS', 'earnings')
 
     def get_url(self):
-        return BASE_URL.format(self.value[0], '{}')
+        return get_base_url().format(self.value[0], '{}')
 
     def get_url_name(self):
         return self.value[0]
@@ -0,0 +1,68 @@
+import logging
+import os
+import threading
+from time import sleep
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+POLL_INTERVAL = 0.05  # seconds between attempts to take the lock on Windows
+LOGGER = logging.getLogger(__name__)
+
+
+class FileLock:
+    """
+    Inter-process lock on a lock file: flock on POSIX, a locked byte on Windows. The operating system releases it
+    when the process holding it exits, even on a crash, so a lock is never left behind and never has to be broken.
+    The lock file itself stays in place. The lock also excludes the threads sharing an instance.
+    Use it as a context manager around reads and writes of a file shared by several processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.thread_lock = threading.Lock()
+
+    def acquire(self):
+        self.thread_lock.acquire()
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                else:
+                    while True:
+                        try:
+                            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                            break
+                        except OSError:
+                            sleep(POLL_INTERVAL)
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        self.fd = fd
+
+    def release(self):
+        fd, self.fd = self.fd, None
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+            self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import threading
+from time import perf_counter
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # seconds
+PROMETHEUS_PREFIX = 'intrinsic_value_'
+SLOWEST_SYMBOLS = 10  # symbols listed in the summary
+LOGGER = logging.getLogger(__name__)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed bucket upper bounds, like a Prometheus histogram.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.total, 'max': self.max,
+                'buckets': dict(zip(map(str, self.buckets), self.bucket_counts))}
+
+
+class Timer:
+    """
+    Context manager observing the seconds spent in its block.
+    """
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, perf_counter() - self.start, **self.labels)
+
+
+class NullTimer:
+    """
+    Timer used while metrics are disabled: it doesn't even read the clock.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """
+    Registry of the counters and latency histograms of a run, keyed by name and labels.
+    Every method returns right away while the registry is disabled, so instrumented code costs one attribute
+    lookup when metrics aren't asked for. Every process has its own registry.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.symbol_seconds = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def count(self, name, amount=1, **labels):
+        """
+        Increments a counter.
+        :param name: counter name, ending with '_total'.
+        :param amount: amount to add.
+        :param labels: labels of the counter, e.g. endpoint='OVERVIEW'.
+        :return: void
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """
+        Adds an observation to a latency histogram.
+        :param name: histogram name, ending with '_seconds'.
+        :param seconds: observed duration.
+        :param labels: labels of the histogram, e.g. stage='fetch'.
+        :return: void
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name, **labels):
+        """
+        Times a block of code: `with METRICS.timer('stage_seconds', stage='fetch'): ...`
+        :return: a context manager observing the duration of its block in the histogram `name`.
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def observe_symbol(self, symbol, seconds):
+        """
+        Adds time spent on a symbol. Kept apart from the histograms because there is one entry per symbol.
+        :return: void
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.symbol_seconds[symbol] = self.symbol_seconds.get(symbol, 0.0) + seconds
+
+    def snapshot(self):
+        """
+        :return: every metric as a JSON-serializable dictionary.
+        """
+        with self.lock:
+            return {'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                                 for (name, labels), value in sorted(self.counters.items())],
+                    'histograms': [dict(histogram.as_dict(), name=name, labels=dict(labels))
+                                   for (name, labels), histogram in sorted(self.histograms.items())],
+                    'symbol_seconds': dict(sorted(self.symbol_seconds.items()))}
+
+    def to_prometheus(self):
+        """
+        Formats every counter and histogram in the Prometheus text exposition format, for the textfile collector
+        of node_exporter. Per-symbol times are left out to keep the cardinality low.
+        :return: the metrics as text.
+        """
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                name = PROMETHEUS_PREFIX + name
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name}{format_labels(labels)} {value}')
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                name = PROMETHEUS_PREFIX + name
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} histogram')
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.total}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        :return: a human-readable summary of the run: counters, latencies and the slowest symbols.
+        """
+        lines = ['Counters:']
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'  {name}{format_labels(labels)}: {value:,}')
+
+            lines.append(f"Latencies:{'count':>63} {'total s':>10} {'mean ms':>10} {'max ms':>10}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                mean = histogram.total / histogram.count if histogram.count else 0.0
+                lines.append(f'  {name + format_labels(labels):<60} {histogram.count:>10,} {histogram.total:>10.2f} '
+                             f'{mean * 1000:>10.2f} {histogram.max * 1000:>10.2f}')
+
+            slowest = sorted(self.symbol_seconds.items(), key=lambda item: item[1], reverse=True)[:SLOWEST_SYMBOLS]
+        if slowest:
+            lines.append('Slowest symbols: ' + ', '.join(f'{symbol} ({seconds:.2f} s)' for symbol, seconds in slowest))
+        return '\n'.join(lines)
+
+    def write_snapshot(self, path):
+        """
+        Writes every metric to `path`, in the Prometheus text format if it ends with '.prom', as JSON otherwise.
+        The file is replaced atomically so that a collector never reads a partial file.
+        :param path: file to write.
+        :return: void
+        """
+        content = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.snapshot(), indent=2)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, mode='w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        LOGGER.info("Metrics written to %s", path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+METRICS = Metrics()  # registry of the process, enabled by main with --metrics
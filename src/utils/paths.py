@@ -0,0 +1,34 @@
+import os
+
+DATA_DIR_ENV = 'INTRINSIC_VALUE_DATA_DIR'  # overrides the data directory, e.g. to share it between checkouts
+LOG_DIR_ENV = 'INTRINSIC_VALUE_LOG_DIR'  # overrides the log directory
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Paths are resolved when a file is about to be used, not at import time, so that the environment and the
+# --data-dir option of the command line apply to every module, on every platform.
+
+
+def get_data_dir():
+    """
+    :return: the data directory: $INTRINSIC_VALUE_DATA_DIR, or the 'data' directory of the project.
+    """
+    return os.environ.get(DATA_DIR_ENV) or os.path.join(PROJECT_DIR, 'data')
+
+
+def get_log_dir():
+    """
+    :return: the log directory: $INTRINSIC_VALUE_LOG_DIR, or the 'logs' directory of the project.
+    """
+    return os.environ.get(LOG_DIR_ENV) or os.path.join(PROJECT_DIR, 'logs')
+
+
+def data_path(*parts, create_dir=False):
+    """
+    :param parts: path of a file relative to the data directory, e.g. ('results', '2024-01-31-results.csv').
+    :param create_dir: create the directory of the file if it doesn't exist.
+    :return: the path of the file.
+    """
+    path = os.path.join(get_data_dir(), *parts)
+    if create_dir:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
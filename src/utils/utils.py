@@ -1,11 +1,13 @@
 import csv
-import locale
 import logging
+import math
+import os
 from datetime import date
-from fileinput import filename
 from time import sleep, ctime
-from winsound import Beep
 
+from utils import paths
+
+MISSING_VALUE = 'N/A'  # displayed instead of a missing number
 LOGGER = logging.getLogger(__name__)
 ### Logger utils
 
@@ -21,7 +23,9 @@ def set_up_logger():
     console_handler.setFormatter(console_formatter)
 
     # create a handler for file output (DEBUG and above)
-    file_handler = logging.FileHandler(f'logs/{date.today()}.log', mode='a', encoding='utf-8')
+    log_dir = paths.get_log_dir()
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = logging.FileHandler(os.path.join(log_dir, f'{date.today()}.log'), mode='a', encoding='utf-8')
     file_handler.setLevel(logging.DEBUG)
     file_formatter = logging.Formatter(log_format, style='{', datefmt=date_time_format)
     file_handler.setFormatter(file_formatter)
@@ -80,30 +84,27 @@ def write_to_csv(table, file_path):
 
 ### Calc utils
 
+# (upper bound of beta bucket, WACC); betas at or above the last bound get DEFAULT_WACC
+WACC_BY_BETA = ((0.08, 0.05),
+                (1.0, 0.06),
+                (1.1, 0.065),
+                (1.2, 0.07),
+                (1.3, 0.075),
+                (1.5, 0.08),
+                (1.6, 0.085))
+DEFAULT_WACC = 0.09
+
 def find_wacc(beta: float):
     """
     Calculate Weighted Average Cost of Capital (WACC) based on the beta value.
     :param beta:
     :return:
     """
-    wacc = 0.09
-
-    if beta < .08:
-        wacc = 0.05
-    elif beta < 1.0:
-        wacc = 0.06
-    elif beta < 1.1:
-        wacc = 0.065
-    elif beta < 1.2:
-        wacc = 0.07
-    elif beta < 1.3:
-        wacc = 0.075
-    elif beta < 1.5:
-        wacc = 0.08
-    elif beta < 1.6:
-        wacc = 0.085
-
-    return wacc
+    for upper_bound, wacc in WACC_BY_BETA:
+        if beta < upper_bound:
+            return wacc
+
+    return DEFAULT_WACC
 
 def calculate_annual_growth_rate(end_value: float, start_value: float, periods: int):
     """
@@ -129,31 +130,35 @@ def safe_float(i):
         return 0.0
     return float(i)
 
-def format_currency(amount, local_str=''):
-    try:
-        if local_str:
-            locale.setlocale(locale.LC_ALL, local_str)
-        else:
-            locale.setlocale(locale.LC_ALL, '')  # Use default locale
-
-        if abs(amount) >= 1_000_000_000:
-            formatted_amount = locale.currency(amount / 1_000_000_000, grouping=True) + " B"
-        elif abs(amount) >= 1_000_000:
-            formatted_amount = locale.currency(amount / 1_000_000, grouping=True) + " M"
-        else:
-            formatted_amount = locale.currency(amount, grouping=True)
-
-        return formatted_amount
+def format_currency(amount, currency_symbol='$'):
+    """
+    Formats an amount like the en_US locale does, e.g. '$1,234.56', '-$12.30 M' or '$1.23 B', without touching
+    the process-wide locale, so it is fast and thread-safe.
+    :param amount: amount to format, None or NaN for a missing amount.
+    :param currency_symbol: symbol put before the amount.
+    :return: the formatted amount, or MISSING_VALUE.
+    """
+    if amount is None or not math.isfinite(amount):
+        return MISSING_VALUE
 
-    except locale.Error:
-        return "N/A"
-    finally:
-        locale.setlocale(locale.LC_ALL, '') # Reset locale to default
+    sign = '-' if amount < 0 else ''
+    amount = abs(amount)
+    if amount >= 1_000_000_000:
+        return f'{sign}{currency_symbol}{amount / 1_000_000_000:,.2f} B'
+    if amount >= 1_000_000:
+        return f'{sign}{currency_symbol}{amount / 1_000_000:,.2f} M'
+    return f'{sign}{currency_symbol}{amount:,.2f}'
 
 
 ### Misc utils
 
 def beep():
+    try:
+        from winsound import Beep
+    except ImportError:  # winsound is only available on Windows
+        print('\a', end='', flush=True)
+        return
+
     duration = 100  # milliseconds
     freq = 440  # Hz
     Beep(freq, duration)
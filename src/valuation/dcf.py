@@ -0,0 +1,77 @@
+import numpy as np
+
+from utils import utils
+from valuation.model import STAGE_YEARS, GROWTH_FADE
+
+_WACC_UPPER_BOUNDS = np.array([upper_bound for upper_bound, _ in utils.WACC_BY_BETA])
+_WACC_RATES = np.array([wacc for _, wacc in utils.WACC_BY_BETA] + [utils.DEFAULT_WACC])
+
+
+def find_wacc(beta):
+    """
+    Vectorized version of `utils.find_wacc`: maps every beta to the WACC of its bucket.
+    A NaN beta falls through every bucket and gets the default WACC, as in the scalar version.
+    :param beta: array of beta values.
+    :return: array of WACC values with the same shape as `beta`.
+    """
+    beta = np.asarray(beta, dtype=float)
+    return _WACC_RATES[np.searchsorted(_WACC_UPPER_BOUNDS, beta, side='right')]
+
+
+def geometric_sum(ratio, periods):
+    """
+    Closed form of `ratio ** 1 + ratio ** 2 + ... + ratio ** periods`, element-wise.
+    :param ratio: array of ratios.
+    :param periods: number of terms in the series.
+    :return: array with the sum of the series for every ratio.
+    """
+    ratio = np.asarray(ratio, dtype=float)
+    is_one = np.abs(1.0 - ratio) < 1e-12
+    safe_denominator = np.where(is_one, 1.0, 1.0 - ratio)
+    return np.where(is_one, float(periods), ratio * (1.0 - ratio ** periods) / safe_denominator)
+
+
+def discounted_cashflows(free_cash_flow, growth, wacc, fade=GROWTH_FADE):
+    """
+    Present value of the free cash flows over all the stages in `STAGE_YEARS`. The growth rate of every stage
+    is `fade` times the growth rate of the previous one. All arguments are broadcast against each other.
+    :param free_cash_flow: free cash flow of the last year.
+    :param growth: growth rate of the first stage as a decimal.
+    :param wacc: discount rate as a decimal.
+    :param fade: fraction of the growth rate carried over from one stage to the next.
+    :return: array with the sum of the discounted cash flows.
+    """
+    growth = np.asarray(growth, dtype=float)
+    discount_factor = 1.0 / (1.0 + np.asarray(wacc, dtype=float))
+    free_cash_flow = np.asarray(free_cash_flow, dtype=float)
+
+    total = np.zeros(np.broadcast_shapes(free_cash_flow.shape, growth.shape, discount_factor.shape,
+                                         np.shape(fade)))
+    stage_discount = 1.0  # discount factor at the start of the stage
+    for years in STAGE_YEARS:
+        total = total + free_cash_flow * stage_discount * geometric_sum((1.0 + growth) * discount_factor, years)
+        free_cash_flow = free_cash_flow * (1.0 + growth) ** years
+        stage_discount = stage_discount * discount_factor ** years
+        growth = growth * fade
+
+    return total
+
+
+def compute_fair_prices(free_cash_flow, cash, total_debt, outstanding_shares, beta, eps_next_5y):
+    """
+    Batch version of `Stock.compute_valuation`: values N companies in one pass.
+    Companies without a growth estimate (NaN `eps_next_5y`) get NaN present value and fair price.
+    :param free_cash_flow: array of free cash flows.
+    :param cash: array of cash and short term investments.
+    :param total_debt: array of total debt.
+    :param outstanding_shares: array of outstanding shares.
+    :param beta: array of betas.
+    :param eps_next_5y: array of expected growth rates for the next 5 years.
+    :return: tuple of arrays (present_value, fair_price).
+    """
+    cashflows = discounted_cashflows(free_cash_flow, eps_next_5y, find_wacc(beta))
+    present_value = np.asarray(cash, dtype=float) - np.asarray(total_debt, dtype=float) + cashflows
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fair_price = present_value / np.asarray(outstanding_shares, dtype=float)
+
+    return present_value, fair_price
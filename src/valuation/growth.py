@@ -0,0 +1,141 @@
+import warnings
+
+import numpy as np
+
+from valuation.model import EPS_GROWTH_ESTIMATOR
+
+MIN_REGRESSION_PERIODS = 3  # fewer points don't make a trend
+NORMALIZED_YEARS = 5  # years averaged by the normalized free cash flow
+GROWTH_HEADERS = ['epsCAGR(%)', 'epsTrendGrowth(%)', 'fcfMedianGrowth(%)', 'normalizedFCF']
+GROWTH_COLUMNS = ['eps_cagr', 'eps_regression_growth', 'fcf_median_growth', 'normalized_fcf']  # history store
+
+# Growth estimators over padded arrays: one row per company and one column per fiscal year, oldest first, with NaN
+# for the years a company has no value for. Columns must be consecutive years, a missing year being a column of NaN,
+# since periods are counted in columns. Every estimator handles all the companies at once, and rows without enough
+# data get NaN.
+
+
+def pad(series, years):
+    """
+    Builds a padded array from per-company series.
+    :param series: list of dictionaries of fiscal year to value, one per company.
+    :param years: sorted array of the fiscal years of the columns.
+    :return: float64 array of shape (len(series), len(years)).
+    """
+    values = np.full((len(series), len(years)), np.nan)
+    column = {year: i for i, year in enumerate(np.asarray(years).tolist())}
+    for row, periods in enumerate(series):
+        for year, value in periods.items():
+            values[row, column[year]] = value
+    return values
+
+
+def first_and_last(values):
+    """
+    :param values: padded array.
+    :return: tuple of arrays (column of the first value, column of the last value, whether the row has a value).
+    """
+    valid = ~np.isnan(values)
+    has_value = valid.any(axis=1)
+    first = np.argmax(valid, axis=1)
+    last = values.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    return first, last, has_value
+
+
+def cagr(values):
+    """
+    Batch version of `utils.calculate_annual_growth_rate`, between the first and the last value of every row,
+    over the number of years between them. Turnarounds from a loss to a profit grow linearly, and rows ending
+    with a loss have no growth rate.
+    :param values: padded array.
+    :return: array of annual growth rates as decimals.
+    """
+    if not values.shape[1]:
+        return np.full(len(values), np.nan)
+    first, last, has_value = first_and_last(values)
+    rows = np.arange(len(values))
+    start = values[rows, first]
+    end = values[rows, last]
+    periods = (last - first).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        compound = (end / start) ** (1 / periods) - 1
+        linear = (end - start) / periods / np.abs(start)
+    growth = np.where(start > 0, compound, linear)
+    return np.where(has_value & (periods > 0) & (end > 0) & (start != 0), growth, np.nan)
+
+
+def regression_growth(values, min_periods=MIN_REGRESSION_PERIODS):
+    """
+    Annual growth rate of the log-linear trend of every row, fitted by least squares: less sensitive to the first
+    and last years than `cagr`. Rows with a value that isn't positive have no trend.
+    :param values: padded array.
+    :param min_periods: minimum number of values of a row.
+    :return: array of annual growth rates as decimals.
+    """
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=1)
+    positive = (values > 0).sum(axis=1) == count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.where(valid & (values > 0), np.log(np.where(values > 0, values, 1.0)), 0.0)
+        x = np.where(valid, np.arange(values.shape[1], dtype=float), 0.0)
+        x_mean = x.sum(axis=1) / count
+        y_mean = y.sum(axis=1) / count
+        dx = np.where(valid, x - x_mean[:, None], 0.0)
+        slope = (dx * (y - y_mean[:, None])).sum(axis=1) / (dx * dx).sum(axis=1)
+    return np.where(positive & (count >= min_periods), np.expm1(slope), np.nan)
+
+
+def median_growth(values):
+    """
+    Median of the year-over-year growth rates of every row, over the consecutive years that both have a positive
+    value: robust to a single exceptional year.
+    :param values: padded array.
+    :return: array of growth rates as decimals.
+    """
+    previous = values[:, :-1]
+    current = values[:, 1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        changes = np.where((previous > 0) & (current > 0), current / previous - 1, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # rows without any growth rate
+        return np.nanmedian(changes, axis=1) if changes.shape[1] else np.full(len(values), np.nan)
+
+
+def normalized(values, years=NORMALIZED_YEARS):
+    """
+    Mean of the last `years` values of every row, e.g. a free cash flow smoothed over the business cycle.
+    :param values: padded array.
+    :param years: number of values averaged.
+    :return: array of means.
+    """
+    valid = ~np.isnan(values)
+    rank_from_last = np.cumsum(valid[:, ::-1], axis=1)[:, ::-1]  # 1 for the last value of a row
+    kept = valid & (rank_from_last <= years)
+    count = kept.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(count > 0, np.where(kept, values, 0.0).sum(axis=1) / count, np.nan)
+
+
+EPS_GROWTH_ESTIMATORS = {'cagr': cagr, 'regression': regression_growth}
+
+
+def eps_growth(eps):
+    """
+    Past EPS growth of every row, by the estimator the DCF model uses (model.EPS_GROWTH_ESTIMATOR).
+    :param eps: padded array of annual EPS.
+    :return: array of annual growth rates as decimals, NaN for the rows without one.
+    """
+    return EPS_GROWTH_ESTIMATORS[EPS_GROWTH_ESTIMATOR](eps)
+
+
+def estimate(fundamentals, symbols):
+    """
+    Computes every estimator for many companies at once from their multi-year fundamentals.
+    :param fundamentals: FundamentalsStore holding the annual periods of the companies.
+    :param symbols: stock symbols.
+    :return: dictionary of GROWTH_COLUMNS to arrays in the order of `symbols`.
+    """
+    eps = fundamentals.get('eps', symbols)
+    free_cash_flow = fundamentals.get('free_cash_flow', symbols)
+    return {'eps_cagr': cagr(eps), 'eps_regression_growth': regression_growth(eps),
+            'fcf_median_growth': median_growth(free_cash_flow), 'normalized_fcf': normalized(free_cash_flow)}
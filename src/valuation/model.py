@@ -0,0 +1,14 @@
+# Parameters of the Discounted Cash Flow model, shared by Stock.compute_valuation and the batch engine in dcf.py
+import hashlib
+
+from utils import utils
+
+STAGE_YEARS = (5, 5, 10)  # years 1-5, 6-10 and 11-20
+GROWTH_FADE = 0.5  # the growth rate of every stage is this fraction of the previous stage's growth rate
+EPS_GROWTH_ESTIMATOR = 'regression'  # past EPS growth, one of valuation.growth.EPS_GROWTH_ESTIMATORS
+EPS_GROWTH_SHARE = 0.5  # fraction of the past EPS growth expected for the next 5 years, a conservative estimate
+
+# identifies the parameters above, the growth estimator included, and the WACC table, so that results valued
+# with other parameters can be detected and valued again
+MODEL_VERSION = hashlib.sha1(repr((utils.WACC_BY_BETA, utils.DEFAULT_WACC, STAGE_YEARS, GROWTH_FADE, EPS_GROWTH_ESTIMATOR,
+                                   EPS_GROWTH_SHARE)).encode('utf-8')).hexdigest()[:12]
@@ -0,0 +1,42 @@
+import logging
+
+import numpy as np
+
+from valuation import dcf
+from valuation.model import MODEL_VERSION
+
+INPUT_COLUMNS = ['fcc', 'cash', 'total_debt', 'shares', 'beta', 'eps_next_5y']
+LOGGER = logging.getLogger(__name__)
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):  # empty or 'None' cells
+        return np.nan
+
+
+def revalue_cache(cache_store, only_stale=False):
+    """
+    Values every cached row again from its cached inputs with the current model parameters, in one batch
+    and without any network call. Rows without a growth estimate keep their results.
+    :param cache_store: CacheStore holding the rows to value.
+    :param only_stale: only value the rows valued with another model version.
+    :return: number of rows valued.
+    """
+    rows = [row for row in cache_store.snapshot()
+            if not only_stale or row.get('model_version') != MODEL_VERSION]
+    inputs = {column: np.array([to_float(row[column]) for row in rows]) for column in INPUT_COLUMNS}
+    present_values, fair_prices = dcf.compute_fair_prices(inputs['fcc'], inputs['cash'], inputs['total_debt'],
+                                                          inputs['shares'], inputs['beta'], inputs['eps_next_5y'])
+
+    updates = {}
+    for row, present_value, fair_price in zip(rows, present_values.tolist(), fair_prices.tolist()):
+        if np.isnan(fair_price):
+            LOGGER.warning("[%s] could not be revalued: missing inputs in cache.", row['symbol'])
+            continue
+        updates[row['symbol']] = {'fair_price': fair_price, 'PV': present_value, 'model_version': MODEL_VERSION}
+
+    cache_store.update_many(updates)
+    LOGGER.info("Revalued [%d] of [%d] cached symbols with model version %s.", len(updates), len(rows), MODEL_VERSION)
+    return len(updates)
@@ -0,0 +1,147 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from valuation import dcf
+from valuation.model import GROWTH_FADE
+
+PERCENTILES = (10, 50, 90)
+SCENARIO_HEADERS = ['fairPricePerShareP10', 'fairPricePerShareP50', 'fairPricePerShareP90', 'undervalued(%)']
+SCENARIO_COLUMNS = ['fair_price_p10', 'fair_price_p50', 'fair_price_p90', 'undervalued_probability']  # history store
+MAX_CELLS_PER_CHUNK = 1_000_000  # symbols x scenarios valued at once, bounds the memory of every worker
+MAX_GROUP_STOCKS = 2_000  # stocks collected before their scenarios are valued, bounds the results not written yet
+MIN_WACC = 0.001  # shifted discount rates are clipped to stay positive
+
+# default grid: +/- 2 points of WACC, +/- 4 points of stage 1 growth, and three growth fades
+WACC_SHIFTS = (-0.02, -0.01, 0.0, 0.01, 0.02)
+GROWTH_SHIFTS = (-0.04, -0.02, 0.0, 0.02, 0.04)
+FADES = (0.25, GROWTH_FADE, 0.75)
+
+# default Monte Carlo distributions
+DRAWS = 10_000
+WACC_SD = 0.01
+GROWTH_SD = 0.03
+FADE_RANGE = (0.25, 0.75)
+LOGGER = logging.getLogger(__name__)
+
+
+class Scenarios:
+    """
+    A set of S valuation scenarios. Every scenario shifts the WACC and the stage 1 growth rate of each symbol
+    and sets the growth fade between stages.
+    """
+
+    def __init__(self, wacc_shift, growth_shift, fade):
+        self.wacc_shift = np.asarray(wacc_shift, dtype=float)
+        self.growth_shift = np.asarray(growth_shift, dtype=float)
+        self.fade = np.asarray(fade, dtype=float)
+
+    @classmethod
+    def grid(cls, wacc_shifts=WACC_SHIFTS, growth_shifts=GROWTH_SHIFTS, fades=FADES):
+        """
+        Every combination of the given WACC shifts, growth shifts and fades.
+        :return: Scenarios with len(wacc_shifts) * len(growth_shifts) * len(fades) scenarios.
+        """
+        wacc_shift, growth_shift, fade = np.meshgrid(wacc_shifts, growth_shifts, fades, indexing='ij')
+        return cls(wacc_shift.ravel(), growth_shift.ravel(), fade.ravel())
+
+    @classmethod
+    def monte_carlo(cls, draws=DRAWS, wacc_sd=WACC_SD, growth_sd=GROWTH_SD, fade_range=FADE_RANGE, seed=None):
+        """
+        Random scenarios: normally distributed WACC and growth shifts and uniformly distributed fades.
+        The same draws are used for every symbol.
+        :return: Scenarios with `draws` scenarios.
+        """
+        rng = np.random.default_rng(seed)
+        return cls(rng.normal(0.0, wacc_sd, draws), rng.normal(0.0, growth_sd, draws), rng.uniform(*fade_range, draws))
+
+    def __len__(self):
+        return len(self.fade)
+
+
+def evaluate_chunk(scenarios, free_cash_flow, cash, total_debt, outstanding_shares, beta, eps_next_5y, current_price):
+    """
+    Values a chunk of n symbols under every scenario.
+    :return: tuple (percentiles, undervalued): an (n, len(PERCENTILES)) array of fair prices and
+             an (n,) array with the fraction of scenarios where the fair price is above the current price.
+    """
+    wacc = np.maximum(dcf.find_wacc(beta)[:, None] + scenarios.wacc_shift[None, :], MIN_WACC)
+    growth = eps_next_5y[:, None] + scenarios.growth_shift[None, :]
+    cashflows = dcf.discounted_cashflows(free_cash_flow[:, None], growth, wacc, scenarios.fade[None, :])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fair_prices = ((cash - total_debt)[:, None] + cashflows) / outstanding_shares[:, None]
+
+    percentiles = np.percentile(fair_prices, PERCENTILES, axis=1).T
+    undervalued = np.mean(fair_prices > current_price[:, None], axis=1)
+    undervalued[np.isnan(fair_prices).any(axis=1)] = np.nan
+    return percentiles, undervalued
+
+
+def get_workers(workers):
+    """
+    :param workers: number of processes, 0 for every core.
+    :return: the number of processes to use.
+    """
+    return workers or os.cpu_count() or 1
+
+
+def group_size(scenarios, workers):
+    """
+    :param scenarios: Scenarios the stocks are valued under.
+    :param workers: number of processes, 0 for every core.
+    :return: number of stocks to value under the scenarios at once so that every worker gets a full chunk,
+    at most MAX_GROUP_STOCKS.
+    """
+    return min(MAX_GROUP_STOCKS, max(1, MAX_CELLS_PER_CHUNK // max(1, len(scenarios))) * get_workers(workers))
+
+
+def evaluate(scenarios, free_cash_flow, cash, total_debt, outstanding_shares, beta, eps_next_5y, current_price,
+             workers=1, executor=None):
+    """
+    Values N symbols under every scenario, in chunks of symbols so that at most MAX_CELLS_PER_CHUNK valuations
+    are held in memory per worker. Chunks are spread over `workers` processes, at least one chunk per worker.
+    :param scenarios: Scenarios to value every symbol under.
+    :param workers: number of processes. 0 uses every core.
+    :param executor: ProcessPoolExecutor of `workers` processes to reuse, e.g. for every batch of a run.
+    A pool is started for this call if None.
+    :return: tuple (percentiles, undervalued), see `evaluate_chunk`.
+    """
+    inputs = [np.asarray(column, dtype=float) for column in
+              (free_cash_flow, cash, total_debt, outstanding_shares, beta, eps_next_5y, current_price)]
+    n = len(inputs[0])
+    workers = get_workers(workers)
+    chunk_size = max(1, min(MAX_CELLS_PER_CHUNK // max(1, len(scenarios)), -(-n // workers)))
+    chunks = [[column[start:start + chunk_size] for column in inputs] for start in range(0, n, chunk_size)]
+    LOGGER.info("Valuing [%d] symbols under %d scenarios in %d chunks with %d workers...",
+                n, len(scenarios), len(chunks), workers)
+
+    if workers == 1 or len(chunks) == 1:
+        results = [evaluate_chunk(scenarios, *chunk) for chunk in chunks]
+    elif executor is not None:
+        results = list(executor.map(evaluate_chunk, [scenarios] * len(chunks), *zip(*chunks)))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(evaluate_chunk, [scenarios] * len(chunks), *zip(*chunks)))
+
+    if not results:
+        return np.empty((0, len(PERCENTILES))), np.empty(0)
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+def evaluate_stocks(scenarios, stocks, workers=1, executor=None):
+    """
+    Values valued Stock objects under every scenario.
+    :param scenarios: Scenarios to value every stock under.
+    :param stocks: list of Stock objects with their DCF inputs and current price.
+    :param workers: number of processes. 0 uses every core.
+    :param executor: ProcessPoolExecutor of `workers` processes to reuse, see `evaluate`.
+    :return: tuple (percentiles, undervalued), see `evaluate_chunk`.
+    """
+    def column(attribute):
+        return [np.nan if getattr(stock, attribute) is None else getattr(stock, attribute) for stock in stocks]
+
+    return evaluate(scenarios, column('free_cash_flow'), column('cash'), column('total_debt'),
+                    column('outstanding_shares'), column('beta'), column('eps_next_5y'), column('current_price'),
+                    workers, executor)